@@ -0,0 +1,64 @@
+"""
+Throughput comparison of `binary_replace` with the regex based reference
+implementation on data with many placeholder occurrences.
+
+    python benchmarks/bench_binary_replace.py --size-mb 64 --occurrences 20000
+"""
+
+from argparse import ArgumentParser
+import os
+import time
+
+from ilastik_install.external import _constructor
+
+ORIGINAL_PREFIX = b"/home/conda/feedstock_root/build_artifacts/placehold" * 4
+CURRENT_PREFIX = b"/opt/ilastik-1.4.0-Linux"
+NEW_PREFIX = b"/groups/lab/software/ilastik"
+
+
+def generate_data(size: int, occurrences: int) -> bytes:
+    slot = CURRENT_PREFIX + b"/lib/python3.7" + b"\0" * len(ORIGINAL_PREFIX)
+    filler_length = max(1, size // max(1, occurrences) - len(slot))
+    # random bytes without \0 or the prefix, so that slots are well separated
+    filler = os.urandom(filler_length).replace(b"\0", b"\1").replace(b"/", b"_")
+    return (filler + slot) * occurrences + filler
+
+
+def measure(replace_fn, data: bytes, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        replace_fn(data, ORIGINAL_PREFIX, CURRENT_PREFIX, NEW_PREFIX)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument("--size-mb", type=float, default=32)
+    p.add_argument("--occurrences", type=int, nargs="+", default=[10, 1000, 100000])
+    p.add_argument("--repeat", type=int, default=3)
+    args = p.parse_args()
+
+    size = int(args.size_mb * 2**20)
+    for occurrences in args.occurrences:
+        data = generate_data(size, occurrences)
+        assert _constructor.binary_replace(
+            data, ORIGINAL_PREFIX, CURRENT_PREFIX, NEW_PREFIX
+        ) == _constructor.binary_replace_regex(
+            data, ORIGINAL_PREFIX, CURRENT_PREFIX, NEW_PREFIX
+        )
+        mb = len(data) / 2**20
+        for name, replace_fn in [
+            ("regex", _constructor.binary_replace_regex),
+            ("scanner", _constructor.binary_replace),
+        ]:
+            seconds = measure(replace_fn, data, args.repeat)
+            print(
+                f"{name:>8} occurrences={occurrences:>7} "
+                f"{mb:8.1f} MB {seconds:8.3f} s {mb / seconds:10.1f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Benchmark suite for relocation on a synthetic ilastik-like environment.
+
+Times `core.replace_prefixes` end-to-end (serial, parallel and with the
+relocation caches, which patch binaries in place so that the recorded
+occurrences are used) and `_constructor.binary_replace` on all binaries of the
+environment. Reports files/s, MB/s and the peak RSS of each case, each case
+runs in a fresh process. Results are written as json, pass the json of an
+earlier run with `--compare` to see the relative change:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+"""
+
+from argparse import ArgumentParser
+import concurrent.futures
+import dataclasses
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+from synthetic_env import CURRENT_PREFIX, NEW_PREFIX, ORIGINAL_PREFIX, EnvConfig
+from synthetic_env import generate_env
+
+from ilastik_install import core, pipeline
+from ilastik_install.external import _constructor
+
+PREFIX_MARKER = ".bench_prefix"
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kB on linux, bytes on macos
+    scale = 1 if sys.platform == "darwin" else 2**10
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_rss, children_rss) * scale / 2**20
+
+
+def _run_replace_prefixes(
+    root: pathlib.Path, jobs: int, cached: bool, pipelined: bool = False
+):
+    marker = root / PREFIX_MARKER
+    current_prefix = marker.read_text() if marker.exists() else CURRENT_PREFIX
+    new_prefix = NEW_PREFIX if current_prefix == CURRENT_PREFIX else CURRENT_PREFIX
+    kwargs = {}
+    if cached:
+        kwargs["index_path"] = root / ".relocation_index"
+        kwargs["occurrences_path"] = root / ".relocation_occurrences"
+        # occurrences are only recorded for binaries patched in place
+        kwargs["inplace"] = True
+    if pipelined:
+        kwargs["pipeline_config"] = pipeline.PipelineConfig(workers=jobs)
+    start = time.perf_counter()
+    errors = core.replace_prefixes(
+        root / "conda-meta",
+        root,
+        pathlib.Path(current_prefix),
+        pathlib.Path(new_prefix),
+        jobs=jobs,
+        **kwargs,
+    )
+    seconds = time.perf_counter() - start
+    assert errors == [], errors
+    marker.write_text(new_prefix)
+    return seconds
+
+
+def _run_binary_replace(root: pathlib.Path):
+    marker = root / PREFIX_MARKER
+    current_prefix = marker.read_text() if marker.exists() else CURRENT_PREFIX
+    seconds = 0.0
+    for file_spec in core.collect_file_specs(root / "conda-meta", root):
+        if file_spec.mode != "binary":
+            continue
+        data = file_spec.path.read_bytes()
+        start = time.perf_counter()
+        _constructor.binary_replace(
+            data,
+            ORIGINAL_PREFIX.encode("utf-8"),
+            current_prefix.encode("utf-8"),
+            NEW_PREFIX.encode("utf-8"),
+        )
+        seconds += time.perf_counter() - start
+    return seconds
+
+
+def run_case(case: typing.Dict, root: pathlib.Path) -> typing.Dict:
+    if case["kind"] == "replace_prefixes":
+        seconds = _run_replace_prefixes(
+            root, case["jobs"], case["cached"], case.get("pipelined", False)
+        )
+    else:
+        seconds = _run_binary_replace(root)
+    return {"seconds": seconds, "peak_rss_mb": _peak_rss_mb()}
+
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=pathlib.Path(__file__).parent,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: typing.List[typing.Dict], baseline_path: pathlib.Path):
+    with baseline_path.open("r") as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+    print(f"\ncompared to {baseline_path} (time ratio, <1 is faster):")
+    for result in results:
+        if result["name"] in baseline:
+            ratio = result["seconds"] / baseline[result["name"]]["seconds"]
+            print(f"{result['name']:>28} {ratio:6.2f}")
+
+
+def main():
+    p = ArgumentParser(description=__doc__)
+    defaults = EnvConfig()
+    for field in dataclasses.fields(EnvConfig):
+        p.add_argument(
+            f"--{field.name.replace('_', '-')}",
+            type=field.type,
+            default=getattr(defaults, field.name),
+        )
+    p.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--output", type=pathlib.Path, default="benchmark_results.json")
+    p.add_argument("--compare", type=pathlib.Path)
+    p.add_argument(
+        "--workdir", type=pathlib.Path, help="where to generate the environment"
+    )
+    args = p.parse_args()
+    config = EnvConfig(
+        **{
+            field.name: getattr(args, field.name)
+            for field in dataclasses.fields(EnvConfig)
+        }
+    )
+
+    cases = [
+        {"name": "replace_prefixes", "kind": "replace_prefixes", "jobs": 1},
+        {"name": f"replace_prefixes-j{args.jobs}", "kind": "replace_prefixes"},
+        {"name": "replace_prefixes-cache-build", "kind": "replace_prefixes"},
+        {"name": "replace_prefixes-cache-warm", "kind": "replace_prefixes"},
+        {"name": "replace_prefixes-pipeline", "kind": "replace_prefixes"},
+        {"name": "binary_replace", "kind": "binary_replace"},
+    ]
+    cases[0].update(cached=False)
+    cases[1].update(jobs=args.jobs, cached=False)
+    cases[2].update(jobs=1, cached=True)
+    cases[3].update(jobs=1, cached=True)
+    cases[4].update(jobs=1, cached=False, pipelined=True)
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tmp_dir:
+        root = pathlib.Path(tmp_dir)
+        start = time.perf_counter()
+        stats = generate_env(root, config)
+        print(
+            f"generated {stats['text_files']} text and {stats['binary_files']} "
+            f"binary files ({stats['bytes'] / 2 ** 20:.1f} MB) "
+            f"in {time.perf_counter() - start:.1f} s"
+        )
+        binary_bytes = sum(
+            spec.path.stat().st_size
+            for spec in core.collect_file_specs(root / "conda-meta", root)
+            if spec.mode == "binary"
+        )
+
+        results = []
+        spawn = multiprocessing.get_context("spawn")
+        for case in cases:
+            # fresh process per case, for a meaningful peak RSS
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=spawn
+            ) as executor:
+                measurement = executor.submit(run_case, case, root).result()
+            if case["kind"] == "binary_replace":
+                files, n_bytes = stats["binary_files"], binary_bytes
+            else:
+                files = stats["text_files"] + stats["binary_files"]
+                n_bytes = stats["bytes"]
+            result = {
+                "name": case["name"],
+                "files": files,
+                "bytes": n_bytes,
+                "files_per_s": files / measurement["seconds"],
+                "mb_per_s": n_bytes / 2**20 / measurement["seconds"],
+                **measurement,
+            }
+            results.append(result)
+            print(
+                f"{result['name']:>28} {result['seconds']:8.2f} s "
+                f"{result['files_per_s']:10.0f} files/s "
+                f"{result['mb_per_s']:8.1f} MB/s "
+                f"{result['peak_rss_mb']:8.1f} MB peak RSS"
+            )
+
+    with args.output.open("w") as f:
+        json.dump(
+            {
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "config": dataclasses.asdict(config),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
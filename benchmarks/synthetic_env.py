@@ -0,0 +1,134 @@
+"""
+Generator for synthetic ilastik-like environments.
+
+The generated environment contains `conda-meta/*.json` package specs with
+`paths_data` in the format written by conda, text files (headers, pkg-config,
+cmake and json files) and binaries with null-padded prefix slots.
+"""
+
+import dataclasses
+import json
+import os
+import pathlib
+import random
+import typing
+
+ORIGINAL_PREFIX = (
+    "/home/conda/feedstock_root/build_artifacts/pkg_1234456789"
+    "/_h_env_placehold_placehold_placehold_placehold_placehold_placehold"
+    "_placehold_placehold_placehold_placehold_placehold_placehold_placehold"
+)
+CURRENT_PREFIX = "/opt/ilastik-1.4.0-Linux/placeholder_placeholder_placeholder"
+NEW_PREFIX = "/groups/lab/software/ilastik-1.4.0-Linux"
+
+TEXT_SUFFIXES = [".h", ".pc", ".cmake", ".json", ".py", ".sh"]
+
+
+@dataclasses.dataclass
+class EnvConfig:
+    packages: int = 1000
+    # files with prefix
+    text_files_per_package: int = 4
+    text_file_kb: float = 8
+    # fraction of packages that contain a binary with prefix
+    binary_fraction: float = 0.3
+    binary_kb: float = 512
+    # a few huge shared libraries (Qt, VTK, LLVM, ...)
+    large_binaries: int = 4
+    large_binary_mb: float = 64
+    # files without prefix, listed in paths_data but never relocated
+    plain_files_per_package: int = 10
+    # prefix occurrences per MB (at least one per file)
+    occurrences_per_mb: float = 200
+    seed: int = 42
+
+
+def _filler(rng: random.Random, size: int, text: bool) -> bytes:
+    if text:
+        line = bytes(rng.choices(b"abcdefghijklmnopqrstuvwxyz_ ", k=79)) + b"\n"
+        return (line * (size // len(line) + 1))[:size]
+    # no \0s and no "/", so that slots are well separated
+    return os.urandom(size).replace(b"\0", b"\1").replace(b"/", b"_")
+
+
+def _occurrences(size: int, config: EnvConfig) -> int:
+    return max(1, round(size / 2**20 * config.occurrences_per_mb))
+
+
+def make_text(rng: random.Random, size: int, config: EnvConfig) -> bytes:
+    occurrences = _occurrences(size, config)
+    filler = _filler(rng, size // occurrences, text=True)
+    return (filler + CURRENT_PREFIX.encode("utf-8") + b"/lib\n") * occurrences
+
+
+def make_binary(rng: random.Random, size: int, config: EnvConfig) -> bytes:
+    occurrences = _occurrences(size, config)
+    original = ORIGINAL_PREFIX.encode("utf-8")
+    current = CURRENT_PREFIX.encode("utf-8")
+    slot = current + b"/lib" + b"\0" * (len(original) - len(current) + 1)
+    filler = _filler(rng, max(1, size // occurrences - len(slot)), text=False)
+    return (filler + slot) * occurrences
+
+
+def _write(root: pathlib.Path, path: str, data: bytes):
+    full_path = root / path
+    full_path.parent.mkdir(parents=True, exist_ok=True)
+    full_path.write_bytes(data)
+
+
+def generate_env(root: pathlib.Path, config: EnvConfig) -> typing.Dict[str, int]:
+    """
+    Generate a synthetic environment in `root`, installed at CURRENT_PREFIX.
+
+    Returns the number of files and bytes to be relocated.
+    """
+    rng = random.Random(config.seed)
+    conda_meta = root / "conda-meta"
+    conda_meta.mkdir(parents=True, exist_ok=True)
+    stats = {"text_files": 0, "binary_files": 0, "bytes": 0}
+    large_packages = set(rng.sample(range(config.packages), config.large_binaries))
+    for n in range(config.packages):
+        name = f"pkg{n:05d}"
+        paths = []
+        for i in range(config.text_files_per_package):
+            path = f"share/{name}/file{i}{rng.choice(TEXT_SUFFIXES)}"
+            size = int(rng.lognormvariate(0, 1) * config.text_file_kb * 1024)
+            data = make_text(rng, max(size, 256), config)
+            _write(root, path, data)
+            paths.append(
+                {
+                    "_path": path,
+                    "file_mode": "text",
+                    "prefix_placeholder": ORIGINAL_PREFIX,
+                    "path_type": "hardlink",
+                }
+            )
+            stats["text_files"] += 1
+            stats["bytes"] += len(data)
+        binaries = []
+        if rng.random() < config.binary_fraction:
+            size = int(rng.lognormvariate(0, 1) * config.binary_kb * 1024)
+            binaries.append((f"lib/lib{name}.so", max(size, 4096)))
+        if n in large_packages:
+            size = int(config.large_binary_mb * 2**20)
+            binaries.append((f"lib/lib{name}_large.so", size))
+        for path, size in binaries:
+            data = make_binary(rng, size, config)
+            _write(root, path, data)
+            paths.append(
+                {
+                    "_path": path,
+                    "file_mode": "binary",
+                    "prefix_placeholder": ORIGINAL_PREFIX,
+                    "path_type": "hardlink",
+                }
+            )
+            stats["binary_files"] += 1
+            stats["bytes"] += len(data)
+        for i in range(config.plain_files_per_package):
+            path = f"lib/python3.7/site-packages/{name}/module{i}.py"
+            _write(root, path, b"import os\n")
+            paths.append({"_path": path, "path_type": "hardlink", "size_in_bytes": 10})
+        with (conda_meta / f"{name}-1.0-0.json").open("w") as f:
+            json.dump({"name": name, "paths_data": {"paths": paths}}, f)
+    return stats
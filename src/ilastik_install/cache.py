@@ -0,0 +1,133 @@
+"""
+Content addressed cache of relocated files, shared across installs.
+
+Entries are keyed by the sha256 of the file in the package (from
+`paths_data`), the size of the installed file and the prefixes relocated
+from and to. Relocated files are hardlinked into the cache, later
+relocations of the same file between the same prefixes link (or copy) the
+cached file into the install instead of reading and rewriting it.
+
+Cached files are shared with the installs they were linked to. Relocation
+never modifies files in place that have links outside of the relocated paths
+(see `core.group_hardlinks`), so cache entries stay intact.
+
+The cache is trimmed to its size limit by removing the least recently used
+entries. Use is tracked in a stamp file per entry (`<key>.used`) that belongs
+to the cache: the mtime of an entry is shared with the installs it is linked
+to (where it guards recorded occurrences) and can only be changed by its
+owner.
+"""
+
+import hashlib
+import logging
+import os
+import pathlib
+import typing
+
+from ilastik_install.external import _constructor
+
+logger = logging.getLogger(__name__)
+
+USED_SUFFIX = ".used"
+
+
+class RelocationCache:
+    def __init__(self, cache_path: pathlib.Path, max_size: typing.Optional[int] = None):
+        self.cache_path = cache_path
+        self.max_size = max_size
+
+    @staticmethod
+    def key(sha256: str, size: int, current_prefix: str, new_prefix: str) -> str:
+        return hashlib.sha256(
+            "\0".join([sha256, str(size), current_prefix, new_prefix]).encode("utf-8")
+        ).hexdigest()
+
+    def entry_path(self, key: str) -> pathlib.Path:
+        return self.cache_path / key[:2] / key
+
+    def used_path(self, key: str) -> pathlib.Path:
+        return self.cache_path / key[:2] / f"{key}{USED_SUFFIX}"
+
+    def _touch(self, key: str):
+        """Record that `key` was used now, best effort"""
+        used_path = self.used_path(key)
+        try:
+            try:
+                os.utime(used_path)
+            except OSError:
+                # missing, or created by another user: replace it
+                tmp_path = used_path.with_name(f".{used_path.name}.{os.getpid()}")
+                tmp_path.touch()
+                os.replace(tmp_path, used_path)
+        except OSError as e:
+            logger.debug(f"Could not record use of cache entry {key}: {e!r}")
+
+    def _link(self, source: pathlib.Path, destination: pathlib.Path):
+        """
+        Atomically replace `destination` with a hardlink to `source`, or a copy
+        (reflinked where supported) if they are on different filesystems.
+        """
+        tmp_path = destination.with_name(f".{destination.name}.{os.getpid()}.cache")
+        try:
+            try:
+                os.link(source, tmp_path)
+            except OSError:
+                _constructor.fast_copy(source, tmp_path)
+                os.chmod(tmp_path, source.stat().st_mode)
+            os.replace(tmp_path, destination)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def fetch(self, key: str, path: pathlib.Path) -> bool:
+        """Replace `path` with the cached file, False if it is not cached"""
+        entry_path = self.entry_path(key)
+        try:
+            self._link(entry_path, path)
+        except FileNotFoundError:
+            return False
+        self._touch(key)
+        return True
+
+    def store(self, key: str, path: pathlib.Path):
+        """Add the relocated file at `path` to the cache"""
+        entry_path = self.entry_path(key)
+        if entry_path.exists():
+            return
+        try:
+            entry_path.parent.mkdir(parents=True, exist_ok=True)
+            self._link(path, entry_path)
+        except OSError as e:
+            logger.warning(f"Could not cache {path}: {e!r}")
+            return
+        self._touch(key)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits `max_size`"""
+        if self.max_size is None or not self.cache_path.exists():
+            return
+        entries = []
+        for entry_path in self.cache_path.glob("*/*"):
+            if entry_path.name.startswith(".") or entry_path.suffix == USED_SUFFIX:
+                continue
+            try:
+                st = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            try:
+                last_used = self.used_path(entry_path.name).stat().st_mtime
+            except FileNotFoundError:
+                last_used = st.st_mtime
+            entries.append((last_used, st.st_size, entry_path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.debug(f"evicting {entry_path} from relocation cache")
+            for path in [entry_path, self.used_path(entry_path.name)]:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            total -= size
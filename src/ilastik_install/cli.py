@@ -1,13 +1,28 @@
 import pathlib
-from argparse import ArgumentParser, Namespace
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
 import logging
-from ilastik_install import core
+from ilastik_install import (
+    cache,
+    copy_relocate,
+    core,
+    extract,
+    journal,
+    pipeline,
+    report,
+    schedule,
+    verify,
+)
 import dataclasses
 import json
+import os
 import sys
+import typing
 
 logger = logging.getLogger(__name__)
 
+# number of earlier prefixes kept in the prefix file
+MAX_HISTORY = 16
+
 
 @dataclasses.dataclass
 class PrefixConfig(core.JsonConfig):
@@ -15,12 +30,40 @@ class PrefixConfig(core.JsonConfig):
     clean: bool = dataclasses.field(init=False)
     prefix: bool = dataclasses.field(init=False)
     valid: bool = dataclasses.field(init=False)
+    fingerprint: typing.Optional[str] = dataclasses.field(init=False)
+    # prefixes of earlier relocations, most recent first
+    history: typing.List[pathlib.Path] = dataclasses.field(init=False)
 
     def __post_init__(self):
         super().__post_init__()
         self.valid = self.spec_path.parent == self.root_path
         self.prefix = pathlib.Path(self.json_specs["previous_prefix"])
         self.clean = self.valid and self.prefix == self.root_path
+        self.fingerprint = self.json_specs.get("fingerprint")
+        self.history = [pathlib.Path(p) for p in self.json_specs.get("history", [])]
+
+    def relocation_needed(self) -> bool:
+        """
+        False if the install was relocated to `root_path` before and did not
+        change since then.
+        """
+        if not self.clean or self.fingerprint is None:
+            return True
+        return self.fingerprint != core.install_fingerprint(self.root_path)
+
+
+def positive_int(text: str) -> int:
+    value = int(text)
+    if value < 1:
+        raise ArgumentTypeError(f"has to be at least 1: {text}")
+    return value
+
+
+def non_negative_int(text: str) -> int:
+    value = int(text)
+    if value < 0:
+        raise ArgumentTypeError(f"has to be at least 0: {text}")
+    return value
 
 
 def parse_args() -> Namespace:
@@ -48,6 +91,123 @@ def parse_args() -> Namespace:
         type=str,
         help="New prefix to replace the old one with." "Will be derived with.",
     )
+    p.add_argument(
+        "--jobs",
+        "-j",
+        type=non_negative_int,
+        default=1,
+        help="Number of worker processes used for relocation, 0 uses all cores.",
+    )
+    p.add_argument(
+        "--pipeline",
+        action="store_true",
+        help=(
+            "Relocate in a pipeline of reader, worker and writer threads, keeping "
+            "many reads and writes in flight (for network filesystems)."
+        ),
+    )
+    p.add_argument(
+        "--readers",
+        type=positive_int,
+        default=pipeline.PipelineConfig.readers,
+        help="Number of reader threads with --pipeline.",
+    )
+    p.add_argument(
+        "--writers",
+        type=positive_int,
+        default=pipeline.PipelineConfig.writers,
+        help="Number of writer threads with --pipeline.",
+    )
+    p.add_argument(
+        "--queue-depth",
+        type=positive_int,
+        default=pipeline.PipelineConfig.queue_depth,
+        help="Maximum number of files queued between stages with --pipeline.",
+    )
+    p.add_argument(
+        "--inplace",
+        action="store_true",
+        help="Patch binaries in place instead of rewriting them. Only safe if "
+        "the install is not in use: processes of other users that map a file "
+        "can not be detected and would see it change.",
+    )
+    p.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record timings and statistics per phase and file in a json report.",
+    )
+    p.add_argument(
+        "--max-memory",
+        type=schedule.parse_size,
+        default=None,
+        metavar="SIZE",
+        help="Only relocate files in parallel while their estimated memory stays "
+        "below SIZE (e.g. 512M, 2G). Files are relocated largest first.",
+    )
+    p.add_argument(
+        "--report",
+        type=pathlib.Path,
+        default=None,
+        help="Path of the json report (implies --profile), default: relocate-report.json",
+    )
+    p.add_argument(
+        "--force",
+        action="store_true",
+        help="Relocate even if the install seems to be relocated already.",
+    )
+    p.add_argument(
+        "--cache",
+        type=pathlib.Path,
+        default=None,
+        metavar="DIR",
+        help="Relocation cache shared across installs: files relocated between "
+        "the same prefixes before are linked from DIR instead of rewritten.",
+    )
+    p.add_argument(
+        "--cache-size",
+        type=schedule.parse_size,
+        default="4G",
+        metavar="SIZE",
+        help="Least recently used files are removed from the cache above SIZE "
+        "(default: 4G).",
+    )
+    p.add_argument(
+        "--copy-to",
+        type=pathlib.Path,
+        nargs="+",
+        default=None,
+        metavar="DEST",
+        help="Copy the install to each DEST and relocate it there in a single "
+        "pass, leaving root untouched. The install is read once for all DESTs.",
+    )
+    p.add_argument(
+        "--from-archive",
+        type=pathlib.Path,
+        default=None,
+        metavar="ARCHIVE",
+        help="Extract the install from the tarball ARCHIVE to root, relocating "
+        "files while they are extracted.",
+    )
+    p.add_argument(
+        "--write-manifest",
+        action="store_true",
+        help="Only write the manifest of --from-archive next to the archive, so "
+        "that extraction does not have to read the archive twice.",
+    )
+
+    p.add_argument(
+        "--verify",
+        action="store_true",
+        help="Record the expected digests of the relocated files while they are "
+        "written and check the install against them after the relocation. An "
+        "install that is relocated already is only verified.",
+    )
+    p.add_argument(
+        "--verify-only",
+        action="store_true",
+        help="Only check the install against the digests recorded by the last "
+        "relocation with --verify, without rewriting anything.",
+    )
 
     args = p.parse_args()
     return args
@@ -67,10 +227,20 @@ def setup_logging():
     logger.debug("----------Starting relocation--------")
 
 
-def update_prefix_file(file_path: pathlib.Path, curren_prefix: str):
+def update_prefix_file(
+    file_path: pathlib.Path,
+    curren_prefix: str,
+    fingerprint: typing.Optional[str] = None,
+    history: typing.Sequence[pathlib.Path] = (),
+):
     logger.debug(f"updating prefix file {file_path.as_posix()} with {curren_prefix}")
+    prefix_specs = {"previous_prefix": curren_prefix.as_posix()}
+    if fingerprint is not None:
+        prefix_specs["fingerprint"] = fingerprint
+    if history:
+        prefix_specs["history"] = [prefix.as_posix() for prefix in history]
     with file_path.open("w") as f:
-        json.dump({"previous_prefix": curren_prefix.as_posix()}, f)
+        json.dump(prefix_specs, f)
 
 
 def excepthook(exception_type, exception_value, exception_traceback):
@@ -84,6 +254,79 @@ def excepthook(exception_type, exception_value, exception_traceback):
 sys.excepthook = excepthook
 
 
+def copy_install(args: Namespace, spec_file: pathlib.Path, prefix_config: PrefixConfig):
+    destinations = [destination.resolve() for destination in args.copy_to]
+    for destination in destinations:
+        if destination.exists() and any(destination.iterdir()):
+            logger.error(f"Destination {destination} is not empty")
+            sys.exit(1)
+
+    try:
+        errors = copy_relocate.copy_relocate_many(
+            args.root,
+            [(destination, destination) for destination in destinations],
+            prefix_config.prefix,
+            jobs=args.jobs,
+        )
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    if errors:
+        logger.error(
+            f"Copy failed for {len(errors)} file(s). The copies might be corrupt!"
+        )
+        sys.exit(1)
+    for destination in destinations:
+        update_prefix_file(
+            destination / spec_file.relative_to(args.root),
+            destination,
+            core.install_fingerprint(destination),
+        )
+
+
+def extract_install(args: Namespace, spec_file: str):
+    archive = args.from_archive.resolve()
+    if args.write_manifest:
+        manifest_path = extract.write_manifest(archive, spec_file)
+        logger.info(f"wrote manifest {manifest_path}")
+        return
+    if args.root.exists() and any(args.root.iterdir()):
+        logger.error(f"Destination {args.root} is not empty")
+        sys.exit(1)
+
+    errors = extract.extract_relocate(
+        archive, args.root, args.root, prefix_file=spec_file
+    )
+    if errors:
+        logger.error(
+            f"Extraction failed for {len(errors)} file(s). Your installation might be corrupt!"
+        )
+        sys.exit(1)
+    update_prefix_file(
+        args.root / spec_file, args.root, core.install_fingerprint(args.root)
+    )
+
+
+def verify_install(root: pathlib.Path, digests_path: pathlib.Path):
+    manifest = verify.DigestManifest.load(digests_path)
+    if manifest is None:
+        logger.error(
+            f"Could not find digests at {digests_path}, relocate with --verify first"
+        )
+        sys.exit(1)
+    if manifest.new_prefix != root.as_posix():
+        logger.error(
+            f"Digests were recorded for {manifest.new_prefix}, relocate with --verify"
+        )
+        sys.exit(1)
+    errors = verify.verify(root, manifest)
+    if errors:
+        logger.error(
+            f"Verification failed for {len(errors)} file(s). Your installation might be corrupt!"
+        )
+        sys.exit(1)
+
+
 def main():
     setup_logging()
     args = parse_args()
@@ -95,6 +338,10 @@ def main():
         )
         spec_file = args.override_prefix_file
 
+    if args.from_archive is not None:
+        extract_install(args, spec_file)
+        return
+
     spec_file = args.root / spec_file
     if not spec_file.exists():
         logger.error(f"Could not find spec file at {spec_file}")
@@ -103,11 +350,79 @@ def main():
     logger.debug(f"trying {spec_file}")
     prefix_config = PrefixConfig(spec_file, args.root)
     logger.debug(prefix_config)
+    digests_path = spec_file.parent / core.DIGESTS_FILE
+    if args.verify_only:
+        verify_install(args.root, digests_path)
+        return
+    if args.copy_to is not None:
+        copy_install(args, spec_file, prefix_config)
+        return
+    if not args.force and not prefix_config.relocation_needed():
+        logger.debug(f"{args.root} is already relocated, nothing to do")
+        if args.verify:
+            verify_install(args.root, digests_path)
+        return
 
-    core.replace_prefixes(
-        args.root / "conda-meta", args.root, prefix_config.prefix, args.root
+    journal_path = spec_file.parent / core.JOURNAL_FILE
+    pipeline_config = None
+    if args.pipeline:
+        pipeline_config = pipeline.PipelineConfig(
+            readers=args.readers,
+            workers=args.jobs or os.cpu_count() or 1,
+            writers=args.writers,
+            queue_depth=args.queue_depth,
+        )
+    relocation_cache = None
+    if args.cache is not None:
+        relocation_cache = cache.RelocationCache(args.cache.resolve(), args.cache_size)
+    relocation_report = None
+    if args.profile or args.report is not None:
+        relocation_report = report.RelocationReport()
+
+    # prefixes of earlier relocations that might still be present
+    history = [
+        prefix
+        for prefix in prefix_config.history
+        if prefix not in (prefix_config.prefix, args.root)
+    ]
+    errors = core.replace_prefixes(
+        args.root / "conda-meta",
+        args.root,
+        prefix_config.prefix,
+        args.root,
+        jobs=args.jobs,
+        index_path=spec_file.parent / core.INDEX_FILE,
+        occurrences_path=spec_file.parent / core.OCCURRENCES_FILE,
+        relocation_report=relocation_report,
+        journal_path=journal_path,
+        pipeline_config=pipeline_config,
+        max_memory=args.max_memory,
+        relocation_cache=relocation_cache,
+        history=history,
+        digests_path=digests_path if args.verify else None,
+        inplace=args.inplace,
+    )
+    if not args.verify:
+        # recorded for an earlier relocation
+        verify.discard(digests_path)
+    if relocation_report is not None:
+        relocation_report.save(args.report or pathlib.Path("relocate-report.json"))
+    if errors:
+        logger.error(
+            f"Relocation failed for {len(errors)} file(s). Your installation might be corrupt!"
+        )
+        sys.exit(1)
+    if args.verify:
+        verify_install(args.root, digests_path)
+    if prefix_config.prefix != args.root:
+        history.insert(0, prefix_config.prefix)
+    update_prefix_file(
+        spec_file,
+        args.root,
+        core.install_fingerprint(args.root),
+        history[:MAX_HISTORY],
     )
-    update_prefix_file(spec_file, args.root)
+    journal.discard(journal_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+"""
+Selective parser for the package specs in conda-meta.
+
+Only a small fraction of the entries in `paths_data.paths` have a prefix
+placeholder. Instead of decoding the whole file, the parser searches the
+json text for the `prefix_placeholder` key and decodes only the entries that
+contain it. Files that do not look like conda package specs are decoded as a
+whole.
+"""
+
+import concurrent.futures
+import json
+import logging
+import pathlib
+import re
+import typing
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_KEY = '"prefix_placeholder"'
+# start of a json object, a { inside of a json string can not be followed by
+# an unescaped "
+_OBJECT_START = re.compile(r'\{\s*"')
+_decoder = json.JSONDecoder()
+
+
+def relocatable_paths(json_specs: typing.Dict) -> typing.Iterator[typing.Dict]:
+    """Entries of a decoded package spec that have a prefix placeholder"""
+    for file_spec in json_specs["paths_data"]["paths"]:
+        if all(x in file_spec for x in ["file_mode", "prefix_placeholder"]):
+            yield file_spec
+
+
+def _entry_at(text: str, start: int, key_pos: int) -> typing.Optional[typing.Tuple]:
+    """
+    The entry containing the placeholder key at `key_pos`, searching
+    backwards for its opening brace from `key_pos` down to `start`.
+
+    Returns (entry, end of the entry) or None if there is no such entry.
+    """
+    pos = key_pos
+    while True:
+        pos = text.rfind("{", start, pos)
+        if pos == -1:
+            return None
+        if not _OBJECT_START.match(text, pos):
+            continue
+        try:
+            entry, end = _decoder.raw_decode(text, pos)
+        except ValueError:
+            continue
+        if end > key_pos and isinstance(entry, dict) and "_path" in entry:
+            return entry, end
+
+
+def iter_relocatable(text: str) -> typing.Iterator[typing.Dict]:
+    """
+    Same entries as `relocatable_paths(json.loads(text))`, decoding only the
+    entries with a prefix placeholder.
+    """
+    pos = text.find('"paths_data"')
+    if pos == -1:
+        yield from relocatable_paths(json.loads(text))
+        return
+    entries = []
+    while True:
+        key_pos = text.find(PLACEHOLDER_KEY, pos)
+        if key_pos == -1:
+            break
+        found = _entry_at(text, pos, key_pos)
+        if found is None:
+            logger.debug("unexpected package spec layout, decoding all of it")
+            yield from relocatable_paths(json.loads(text))
+            return
+        entry, pos = found
+        entries.append(entry)
+    for entry in entries:
+        if "file_mode" in entry:
+            yield entry
+
+
+def read_relocatable(json_file: pathlib.Path) -> typing.List[typing.Dict]:
+    logger.debug(f"Reading json from {json_file.as_posix()}.")
+    with open(json_file, "r") as f:
+        return list(iter_relocatable(f.read()))
+
+
+def read_packages(
+    json_files: typing.Sequence[pathlib.Path], max_workers: int = 8
+) -> typing.Iterator[typing.Tuple[pathlib.Path, typing.List[typing.Dict]]]:
+    """
+    Relocatable entries of all `json_files`, read and parsed by a pool of
+    `max_workers` threads. Yields (json file, entries) in the order of
+    `json_files`.
+    """
+    if len(json_files) <= 1:
+        max_workers = 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from zip(json_files, executor.map(read_relocatable, json_files))
@@ -0,0 +1,226 @@
+"""
+Copy an install to its destination and relocate it in a single pass.
+
+Files with a prefix placeholder are rewritten while they are copied, all
+other files are copied with in-kernel copy primitives where available. Every
+byte of the source is read once and written once.
+"""
+
+import concurrent.futures
+import contextlib
+import logging
+import os
+import pathlib
+import shutil
+import typing
+
+from ilastik_install import core
+from ilastik_install.external import _constructor
+
+logger = logging.getLogger(__name__)
+
+# relocation state of the source, not valid for the copy
+SKIPPED_FILES = {
+    core.INDEX_FILE,
+    core.OCCURRENCES_FILE,
+    core.JOURNAL_FILE,
+    core.DIGESTS_FILE,
+}
+
+
+def copy_file(
+    source: pathlib.Path,
+    targets: typing.Sequence[typing.Tuple[pathlib.Path, str]],
+    file_spec: typing.Optional[core.FileSpec],
+    current_placeholder: str,
+):
+    """
+    Copy `source` to every (destination, new placeholder) of `targets`. Files
+    with a placeholder are read and searched once for all targets.
+    """
+    if file_spec is None or (file_spec.mode == "binary" and _constructor.on_win):
+        for destination, _ in targets:
+            _constructor.fast_copy(source, destination)
+    elif file_spec.mode == "text":
+        with source.open("rb") as fi, contextlib.ExitStack() as stack:
+            _constructor.replace_stream_many(
+                fi,
+                [
+                    (
+                        stack.enter_context(destination.open("wb")),
+                        new_placeholder.encode("utf-8"),
+                    )
+                    for destination, new_placeholder in targets
+                ],
+                current_placeholder.encode("utf-8"),
+            )
+    elif file_spec.mode == "binary":
+        _constructor.copy_binary_replace_many(
+            source,
+            [
+                (destination, new_placeholder.encode("utf-8"))
+                for destination, new_placeholder in targets
+            ],
+            file_spec.original_prefix.encode("utf-8"),
+            current_placeholder.encode("utf-8"),
+        )
+    else:
+        raise ValueError(f"Invalid mode: {file_spec.mode}")
+    for destination, _ in targets:
+        shutil.copymode(source, destination)
+
+
+def check_destination(source_root: pathlib.Path, destination_root: pathlib.Path):
+    """
+    Raises ValueError if one of `source_root` and `destination_root` is inside
+    of the other, the copy would be copied into itself.
+    """
+    source = os.path.realpath(source_root)
+    destination = os.path.realpath(destination_root)
+    if os.path.commonpath([source, destination]) in (source, destination):
+        raise ValueError(
+            f"Can not copy {source_root} to {destination_root}, "
+            "one is inside of the other"
+        )
+
+
+def copy_relocate(
+    source_root: pathlib.Path,
+    destination_root: pathlib.Path,
+    current_placeholder: pathlib.Path,
+    new_placeholder: pathlib.Path,
+    jobs: int = 1,
+) -> core.ResultDict:
+    """
+    Copy the install at `source_root` to `destination_root`, replacing
+    `current_placeholder` with `new_placeholder` in all files listed with a
+    `prefix_placeholder` in conda-meta. Symlinks are copied as symlinks,
+    hardlinks within the install are preserved.
+
+    Files are copied by `jobs` threads (0 uses one per core).
+
+    Returns a list of errors, one entry per file that could not be copied.
+    """
+    return copy_relocate_many(
+        source_root, [(destination_root, new_placeholder)], current_placeholder, jobs
+    )
+
+
+def copy_relocate_many(
+    source_root: pathlib.Path,
+    targets: typing.Sequence[typing.Tuple[pathlib.Path, pathlib.Path]],
+    current_placeholder: pathlib.Path,
+    jobs: int = 1,
+) -> core.ResultDict:
+    """
+    `copy_relocate` to several (destination root, new placeholder) `targets`.
+    conda-meta is parsed and the source tree is walked once, every file is
+    read and searched for placeholders once and written to all targets.
+
+    Raises ValueError if a destination root is inside of `source_root` or vice
+    versa (see `check_destination`).
+
+    Returns a list of errors, one entry per source file that could not be
+    copied to all of the targets.
+    """
+    for destination_root, _ in targets:
+        check_destination(source_root, destination_root)
+    for destination_root, new_placeholder in targets:
+        logger.info(
+            f"copying {source_root} to {destination_root}, updating prefix_path "
+            f"from {current_placeholder} to {new_placeholder}"
+        )
+    file_specs = {
+        file_spec.path.relative_to(source_root).as_posix(): file_spec
+        for file_spec in core.collect_file_specs(
+            source_root / "conda-meta", source_root
+        )
+    }
+    current_prefix = current_placeholder.as_posix()
+    new_prefixes = [new_placeholder.as_posix() for _, new_placeholder in targets]
+
+    # relative paths of all files to copy
+    files = []
+    # hardlinks to create after copying, (first relative path, relative path)
+    hardlinks = []
+    first_links: typing.Dict[typing.Tuple[int, int], str] = {}
+    directories = [""]
+    found = set()
+    for destination_root, _ in targets:
+        destination_root.mkdir(parents=True, exist_ok=True)
+    for dirpath, dirnames, filenames in os.walk(source_root):
+        source_dir = pathlib.Path(dirpath)
+        for name in sorted(dirnames + filenames):
+            source = source_dir / name
+            relative_path = source.relative_to(source_root).as_posix()
+            if relative_path in SKIPPED_FILES:
+                continue
+            found.add(relative_path)
+            st = source.lstat()
+            if source.is_symlink():
+                for destination_root, _ in targets:
+                    os.symlink(os.readlink(source), destination_root / relative_path)
+            elif source.is_dir():
+                for destination_root, _ in targets:
+                    (destination_root / relative_path).mkdir()
+                directories.append(relative_path)
+            elif st.st_nlink > 1 and (st.st_dev, st.st_ino) in first_links:
+                hardlinks.append((first_links[(st.st_dev, st.st_ino)], relative_path))
+            else:
+                if st.st_nlink > 1:
+                    first_links[(st.st_dev, st.st_ino)] = relative_path
+                files.append(relative_path)
+
+    missing = set(file_specs) - found
+    for relative_path in sorted(missing):
+        logger.warning(f"Could not find {relative_path}. ignoring.")
+
+    def copy(relative_path):
+        source = source_root / relative_path
+        try:
+            copy_file(
+                source,
+                [
+                    (destination_root / relative_path, new_prefix)
+                    for (destination_root, _), new_prefix in zip(targets, new_prefixes)
+                ],
+                file_specs.get(relative_path),
+                current_prefix,
+            )
+        except Exception as e:
+            logger.error(f"Could not copy {source}: {e!r}")
+            return {"path": source.as_posix(), "error": repr(e)}
+        return None
+
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(copy, files))
+    errors = [error for error in results if error is not None]
+    failed = {
+        relative_path
+        for relative_path, error in zip(files, results)
+        if error is not None
+    }
+
+    for destination_root, _ in targets:
+        for first_link, relative_path in hardlinks:
+            if first_link in failed:
+                # reported as error already
+                continue
+            try:
+                os.link(destination_root / first_link, destination_root / relative_path)
+            except OSError as e:
+                source = source_root / relative_path
+                logger.error(f"Could not link {source}: {e!r}")
+                errors.append({"path": source.as_posix(), "error": repr(e)})
+        # deepest first, in case directories are read-only
+        for relative_path in reversed(directories):
+            shutil.copystat(
+                source_root / relative_path, destination_root / relative_path
+            )
+    logger.info(
+        f"copied {len(files)} files to {len(targets)} destination(s), relocated "
+        f"{len(set(file_specs) - missing)}, {len(errors)} errors"
+    )
+    return errors
@@ -1,16 +1,38 @@
+import concurrent.futures
+import functools
+import hashlib
+import os
 import pathlib
+import time
 import typing
 import dataclasses
 import json
 
 import logging
 
+from ilastik_install import (
+    cache,
+    conda_meta,
+    index,
+    journal,
+    occurrences,
+    pipeline,
+    report,
+    schedule,
+    verify,
+)
 from ilastik_install.external import _constructor
 
 logger = logging.getLogger(__name__)
 
 ResultDict = typing.List[typing.Dict[str, str]]
 
+# relocation state, stored next to the prefix file
+INDEX_FILE = ".relocation_index"
+OCCURRENCES_FILE = ".relocation_occurrences"
+JOURNAL_FILE = ".relocation_journal"
+DIGESTS_FILE = ".relocation_digests"
+
 
 @dataclasses.dataclass
 class JsonConfig:
@@ -24,11 +46,226 @@ class JsonConfig:
 
 
 class PackageSpec(JsonConfig):
+    """
+    Kept for API compatibility, package specs are read with
+    `conda_meta.read_packages`.
+    """
+
     @property
     def file_iter(self):
-        for file_spec in self.json_specs["paths_data"]["paths"]:
-            if all(x in file_spec for x in ["file_mode", "prefix_placeholder"]):
-                yield file_spec
+        return conda_meta.relocatable_paths(self.json_specs)
+
+
+@dataclasses.dataclass
+class FileSpec:
+    """A single file that needs relocation"""
+
+    path: pathlib.Path
+    mode: str
+    # used to determine the length:
+    original_prefix: str
+    package: str = ""
+    # other paths (hardlinks) of the same file, relinked after relocation
+    hardlinks: typing.List[pathlib.Path] = dataclasses.field(default_factory=list)
+    # patch binaries in place, only if requested and the file is not linked
+    # from outside of the relocated paths
+    inplace: bool = False
+    # in bytes, as stat'ed before relocation
+    size: int = 0
+    # of the file in the package (with the placeholder), from paths_data
+    sha256: str = ""
+
+
+def _index_entries(conda_meta_path: pathlib.Path) -> typing.Iterator[index.IndexEntry]:
+    json_files = list(conda_meta_path.glob("*.json"))
+    for json_file, file_specs in conda_meta.read_packages(json_files):
+        for file_spec in file_specs:
+            yield (
+                json_file.stem,
+                file_spec["_path"],
+                file_spec["file_mode"],
+                file_spec["prefix_placeholder"],
+                file_spec.get("sha256", ""),
+            )
+
+
+def collect_file_specs(
+    conda_meta_path: pathlib.Path,
+    root: pathlib.Path,
+    index_path: typing.Optional[pathlib.Path] = None,
+) -> typing.Iterator[FileSpec]:
+    """
+    All files with a prefix placeholder, either parsed from the package specs
+    in `conda_meta_path`, or - if `index_path` is given - from the cached
+    relocation index (which is rebuilt if conda-meta changed).
+    """
+    if index_path is None:
+        entries = _index_entries(conda_meta_path)
+    else:
+        entries = index.load_or_build(
+            conda_meta_path, index_path, lambda: _index_entries(conda_meta_path)
+        )
+    for package, path, mode, original_prefix, sha256 in entries:
+        yield FileSpec(
+            path=root / path,
+            mode=mode,
+            original_prefix=original_prefix,
+            package=package,
+            sha256=sha256,
+        )
+
+
+@dataclasses.dataclass
+class FileResult:
+    file_spec: FileSpec
+    error: typing.Optional[str] = None
+    # placeholder slots of binary files patched in place
+    record: typing.Optional[occurrences.OccurrenceRecord] = None
+    stats: typing.Optional[_constructor.UpdateStats] = None
+    seconds: float = 0.0
+
+
+def group_hardlinks(
+    file_specs: typing.Iterable[typing.Tuple[FileSpec, os.stat_result]],
+) -> typing.Tuple[typing.List[FileSpec], typing.List[FileSpec]]:
+    """
+    Group file specs by (device, inode), so that every physical file is
+    relocated once. Other hardlinks of a file are added to `hardlinks` of the
+    first spec, paths resolving to the same file (symlinks) are dropped.
+    Files with links outside of `file_specs` are marked to not be written in
+    place, so that e.g. a conda package cache does not get modified.
+
+    Returns the file specs to relocate and the duplicate file specs.
+    """
+    groups: typing.Dict[typing.Tuple[int, int], FileSpec] = {}
+    realpaths: typing.Dict[typing.Tuple[int, int], typing.Set[str]] = {}
+    n_links: typing.Dict[typing.Tuple[int, int], int] = {}
+    unique = []
+    duplicates = []
+    for file_spec, st in file_specs:
+        key = (st.st_dev, st.st_ino)
+        realpath = os.path.realpath(file_spec.path)
+        if key not in groups:
+            groups[key] = file_spec
+            realpaths[key] = {realpath}
+            n_links[key] = st.st_nlink
+            unique.append(file_spec)
+            continue
+        duplicates.append(file_spec)
+        if realpath not in realpaths[key]:
+            realpaths[key].add(realpath)
+            groups[key].hardlinks.append(file_spec.path)
+    for key, file_spec in groups.items():
+        file_spec.inplace = n_links[key] <= len(realpaths[key])
+    return unique, duplicates
+
+
+def install_fingerprint(root: pathlib.Path) -> str:
+    """
+    Cheap fingerprint of the install at `root`, changes whenever packages are
+    added, removed or updated (names, mtimes and sizes of the package specs).
+    """
+    fingerprint = index.conda_meta_fingerprint(root / "conda-meta")
+    return hashlib.sha1(json.dumps(fingerprint).encode("utf-8")).hexdigest()
+
+
+def relocate_file(
+    file_spec: FileSpec,
+    record: typing.Optional[occurrences.OccurrenceRecord],
+    current_placeholders: typing.Sequence[str],
+    new_placeholder: str,
+    digest: bool = False,
+) -> FileResult:
+    """
+    Relocate a single file, errors are returned instead of raised so that
+    failures can be collected per file (also across process boundaries).
+
+    All of `current_placeholders` are replaced by `new_placeholder` in a
+    single pass, `record` are the placeholder occurrences from a previous
+    relocation. With `digest`, the digest of the result is added to the
+    stats while it is written.
+    """
+    start = time.perf_counter()
+    slots = occurrences.guarded_slots(file_spec.path, record)
+    try:
+        stats = _constructor.update_prefix(
+            file_spec.path,
+            file_spec.original_prefix,
+            current_placeholders,
+            new_placeholder,
+            file_spec.mode,
+            inplace=file_spec.inplace,
+            slots=slots,
+            digest=digest,
+        )
+        _constructor.relink(file_spec.path, file_spec.hardlinks)
+    except Exception as e:
+        return FileResult(file_spec, error=repr(e), seconds=time.perf_counter() - start)
+    return _file_result(file_spec, stats, time.perf_counter() - start)
+
+
+def _file_result(
+    file_spec: FileSpec, stats: _constructor.UpdateStats, seconds: float
+) -> FileResult:
+    try:
+        if stats.slots is not None:
+            record = occurrences.make_record(file_spec.path, stats.slots)
+        else:
+            record = None
+    except OSError as e:
+        return FileResult(file_spec, error=repr(e), seconds=seconds)
+    return FileResult(file_spec, record=record, stats=stats, seconds=seconds)
+
+
+def _skipped_report(
+    root: pathlib.Path, file_spec: FileSpec, status: str
+) -> report.FileReport:
+    return report.FileReport(
+        path=file_spec.path.relative_to(root).as_posix(),
+        package=file_spec.package,
+        mode=file_spec.mode,
+        status=status,
+    )
+
+
+def _file_report(root: pathlib.Path, result: FileResult) -> report.FileReport:
+    file_report = report.FileReport(
+        path=result.file_spec.path.relative_to(root).as_posix(),
+        package=result.file_spec.package,
+        mode=result.file_spec.mode,
+        status=report.ERROR,
+        seconds=result.seconds,
+        error=result.error,
+    )
+    if result.stats is not None:
+        file_report.status = (
+            report.MODIFIED if result.stats.modified else report.UNCHANGED
+        )
+        file_report.bytes_read = result.stats.bytes_read
+        file_report.bytes_written = result.stats.bytes_written
+        file_report.matches = result.stats.matches
+        file_report.timings = result.stats.timings
+    return file_report
+
+
+def _with_history(
+    file_spec: FileSpec,
+    prefixes: typing.List[str],
+    history: typing.Sequence[str],
+    new_prefix: str,
+) -> typing.List[str]:
+    """
+    `prefixes` and all of `history` that could be present in the file. Binary
+    files can not contain prefixes longer than their original placeholder.
+    """
+    result = list(prefixes)
+    for prefix in history:
+        if prefix in result or prefix == new_prefix:
+            continue
+        if file_spec.mode == "binary" and len(prefix) > len(file_spec.original_prefix):
+            continue
+        result.append(prefix)
+    return result
 
 
 def replace_prefixes(
@@ -36,24 +273,315 @@ def replace_prefixes(
     root: pathlib.Path,
     current_placeholder: str,
     new_placeholder: str,
-):
+    jobs: int = 1,
+    index_path: typing.Optional[pathlib.Path] = None,
+    occurrences_path: typing.Optional[pathlib.Path] = None,
+    relocation_report: typing.Optional[report.RelocationReport] = None,
+    journal_path: typing.Optional[pathlib.Path] = None,
+    pipeline_config: typing.Optional[pipeline.PipelineConfig] = None,
+    max_memory: typing.Optional[int] = None,
+    relocation_cache: typing.Optional[cache.RelocationCache] = None,
+    history: typing.Sequence[pathlib.Path] = (),
+    digests_path: typing.Optional[pathlib.Path] = None,
+    inplace: bool = False,
+) -> ResultDict:
+    """
+    Replace `current_placeholder` with `new_placeholder` in all files listed
+    with a `prefix_placeholder` in the package specs in `conda_meta_path`.
+
+    With `jobs` > 1 files are distributed to a pool of worker processes,
+    `jobs` == 0 uses all available cores.
+
+    If `index_path` is given, the files to relocate are read from (and cached
+    in) a relocation index at that location instead of parsing all package
+    specs.
+
+    If `occurrences_path` is given, placeholder positions in binary files
+    patched in place (see `inplace`) are recorded there, later relocations
+    patch those positions without scanning the files (as long as they did not
+    change in between).
+
+    Timings and statistics per phase and file are added to `relocation_report`.
+
+    If `journal_path` is given, every relocated file is recorded in a journal
+    there. Files relocated by an interrupted run are skipped (or relocated from
+    the prefix recorded in the journal). The journal has to be removed with
+    `journal.discard` once the new prefix is persisted.
+
+    With `pipeline_config` files are relocated in a pipeline of reader, worker
+    and writer threads (see `pipeline`) instead, `jobs` is ignored then.
+
+    Files are relocated largest first. With `max_memory` (bytes) files are
+    only started while the estimated memory of all files in flight stays
+    below that budget (see `schedule`). The peak is added to the report.
+
+    With `relocation_cache`, files with a sha256 in conda-meta are linked from
+    the cache if they were relocated between the same prefixes before, all
+    other relocated files are added to the cache.
+
+    `history` are prefixes of earlier relocations, that are replaced as well
+    (in the same pass over each file) where they are still present.
+
+    If `digests_path` is given, the digests of all relocated files are
+    recorded there for `verify.verify`. They are computed from the output
+    while it is written, files that are not rewritten are hashed afterwards.
+    Files that still contain one of the replaced prefixes are returned as
+    errors.
+
+    Binary files are rewritten, with `inplace` they are patched in place
+    instead (see `_constructor.update_prefix`). This is only safe if the
+    install is not in use.
+
+    Returns a list of errors, one entry per file that could not be relocated.
+    """
     logger.info(f"updating prefix_path from {current_placeholder} to {new_placeholder}")
-    for json_file in conda_meta_path.glob("*.json"):
-        pkg_spec = PackageSpec(json_file)
-        for file_spec in pkg_spec.file_iter:
-            fullpath = root / file_spec["_path"]
-            mode = file_spec["file_mode"]
-            # used to determine the length:
-            original_prefix = file_spec["prefix_placeholder"]
-
-            if not fullpath.exists():
-                logger.warning(f"Could not find {fullpath.as_posix()}. ignoring.")
+    if relocation_report is None:
+        relocation_report = report.RelocationReport()
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    relocation_report.info.update(
+        current_prefix=current_placeholder.as_posix(),
+        new_prefix=new_placeholder.as_posix(),
+        jobs=jobs,
+    )
+
+    file_specs = []
+    with relocation_report.phase("collect"):
+        for file_spec in collect_file_specs(conda_meta_path, root, index_path):
+            try:
+                st = os.stat(file_spec.path)
+            except FileNotFoundError:
+                logger.warning(f"Could not find {file_spec.path.as_posix()}. ignoring.")
+                relocation_report.add_file(
+                    _skipped_report(root, file_spec, report.MISSING)
+                )
                 continue
-            logger.info(f"modifying {fullpath}:{mode}")
-            _constructor.update_prefix(
-                fullpath,
-                original_prefix,
-                current_placeholder.as_posix(),
-                new_placeholder.as_posix(),
-                mode,
+            logger.info(f"modifying {file_spec.path}:{file_spec.mode}")
+            file_spec.size = st.st_size
+            file_specs.append((file_spec, st))
+        file_specs, duplicates = group_hardlinks(file_specs)
+        if not inplace:
+            for file_spec in file_specs:
+                file_spec.inplace = False
+        for file_spec in duplicates:
+            relocation_report.add_file(
+                _skipped_report(root, file_spec, report.DEDUPLICATED)
+            )
+
+    records = {}
+    with relocation_report.phase("load_occurrences"):
+        if occurrences_path is not None:
+            records = occurrences.load(occurrences_path)
+    keys = [file_spec.path.relative_to(root).as_posix() for file_spec in file_specs]
+    file_records = [records.get(key) for key in keys]
+
+    current_prefix = current_placeholder.as_posix()
+    new_prefix = new_placeholder.as_posix()
+    if journal_path is not None:
+        relocation_journal = journal.RelocationJournal(
+            journal_path, current_prefix, new_prefix
+        )
+        source_prefixes = [
+            relocation_journal.source_prefixes(key, current_prefix, new_prefix)
+            for key in keys
+        ]
+    else:
+        relocation_journal = None
+        source_prefixes = [[current_prefix]] * len(keys)
+
+    pending = []
+    for n, (key, file_spec) in enumerate(zip(keys, file_specs)):
+        if not source_prefixes[n]:
+            logger.debug(f"{key} was relocated to {new_prefix} already")
+            relocation_report.add_file(_skipped_report(root, file_spec, report.SKIPPED))
+        else:
+            pending.append(n)
+
+    def journal_file(key: str, file_spec: FileSpec):
+        if relocation_journal is not None:
+            relocation_journal.record(key, new_prefix)
+            for path in file_spec.hardlinks:
+                relocation_journal.record(path.relative_to(root).as_posix(), new_prefix)
+
+    cache_keys = {}
+    with relocation_report.phase("fetch_cached"):
+        if relocation_cache is not None:
+            uncached = []
+            for n in pending:
+                file_spec = file_specs[n]
+                if not file_spec.sha256 or source_prefixes[n] != [current_prefix]:
+                    uncached.append(n)
+                    continue
+                cache_keys[keys[n]] = cache_key = relocation_cache.key(
+                    file_spec.sha256, file_spec.size, current_prefix, new_prefix
+                )
+                try:
+                    path = pathlib.Path(os.path.realpath(file_spec.path))
+                    if not relocation_cache.fetch(cache_key, path):
+                        uncached.append(n)
+                        continue
+                    _constructor.relink(path, file_spec.hardlinks)
+                except OSError as e:
+                    logger.warning(f"Could not link {file_spec.path} from cache: {e!r}")
+                    uncached.append(n)
+                    continue
+                logger.debug(f"linked {keys[n]} from the relocation cache")
+                relocation_report.add_file(
+                    _skipped_report(root, file_spec, report.CACHED)
+                )
+                journal_file(keys[n], file_spec)
+                records.pop(keys[n], None)
+            pending = uncached
+
+    relocate = functools.partial(
+        relocate_file, new_placeholder=new_prefix, digest=digests_path is not None
+    )
+    pending_keys = [keys[n] for n in pending]
+    pending_specs = [file_specs[n] for n in pending]
+    pending_records = [file_records[n] for n in pending]
+    history_prefixes = [prefix.as_posix() for prefix in history]
+    pending_sources = [
+        _with_history(file_specs[n], source_prefixes[n], history_prefixes, new_prefix)
+        for n in pending
+    ]
+
+    errors = []
+    failed = set()
+    relocated = []
+    # expected digests of the relocated files, see `_constructor.OutputDigest`
+    digests = {}
+
+    def collect(key: str, result: FileResult):
+        relocation_report.add_file(_file_report(root, result))
+        if result.error is not None:
+            logger.error(f"Could not relocate {result.file_spec.path}: {result.error}")
+            errors.append(
+                {"path": result.file_spec.path.as_posix(), "error": result.error}
+            )
+            failed.add(key)
+            return
+        journal_file(key, result.file_spec)
+        relocated.append((key, result.file_spec))
+        if result.stats is not None and result.stats.digest is not None:
+            digests[key] = verify.FileDigest(*result.stats.digest)
+        if result.record is not None:
+            records[key] = result.record
+        else:
+            records.pop(key, None)
+
+    costs = [
+        schedule.estimated_memory(
+            file_spec.mode,
+            file_spec.size,
+            pipelined=pipeline_config is not None,
+            inplace=file_spec.inplace,
+        )
+        for file_spec in pending_specs
+    ]
+    budget = schedule.MemoryBudget(max_memory)
+    try:
+        with relocation_report.phase("relocate"):
+            if pipeline_config is not None:
+                order = schedule.largest_first(costs)
+                results = pipeline.relocate_pipelined(
+                    [pending_specs[n] for n in order],
+                    [pending_sources[n] for n in order],
+                    new_prefix,
+                    pipeline_config,
+                    costs=[costs[n] for n in order],
+                    budget=budget,
+                    digest=digests_path is not None,
+                )
+                for m, stats, error, seconds in results:
+                    n = order[m]
+                    if error is not None:
+                        result = FileResult(
+                            pending_specs[n], error=error, seconds=seconds
+                        )
+                    else:
+                        result = _file_result(pending_specs[n], stats, seconds)
+                    collect(pending_keys[n], result)
+            elif jobs == 1 or len(pending) <= 1:
+                for key, cost, result in zip(
+                    pending_keys,
+                    costs,
+                    map(relocate, pending_specs, pending_records, pending_sources),
+                ):
+                    # one file at a time
+                    budget.peak = max(budget.peak, cost)
+                    collect(key, result)
+            else:
+                logger.debug(
+                    f"relocating {len(pending)} files with {jobs} processes, "
+                    f"memory budget {max_memory} bytes"
+                )
+                # one file at a time per worker, largest first, so that big
+                # files are spread over the workers
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs
+                ) as executor:
+                    results = schedule.budgeted_map(
+                        executor,
+                        relocate,
+                        costs,
+                        budget,
+                        pending_specs,
+                        pending_records,
+                        pending_sources,
+                        max_pending=jobs,
+                    )
+                    for n, result in results:
+                        collect(pending_keys[n], result)
+    finally:
+        if relocation_journal is not None:
+            relocation_journal.close()
+    # estimated peak of all files in flight together, measured peak of the
+    # largest single process
+    relocation_report.info.update(
+        max_memory=max_memory,
+        peak_memory_estimate=budget.peak,
+        peak_rss=schedule.peak_rss(),
+    )
+    logger.info(
+        f"estimated peak memory {budget.peak} bytes (budget {max_memory}), "
+        f"peak rss of the largest process {relocation_report.info['peak_rss']} bytes"
+    )
+
+    with relocation_report.phase("store_cached"):
+        if relocation_cache is not None:
+            for key, file_spec in relocated:
+                if key in cache_keys:
+                    relocation_cache.store(
+                        cache_keys[key], pathlib.Path(os.path.realpath(file_spec.path))
+                    )
+            relocation_cache.evict()
+
+    with relocation_report.phase("save_occurrences"):
+        if occurrences_path is not None:
+            try:
+                occurrences.save(occurrences_path, records)
+            except OSError as e:
+                logger.warning(f"Could not write occurrences {occurrences_path}: {e!r}")
+
+    with relocation_report.phase("record_digests"):
+        if digests_path is not None:
+            digest_keys = [key for key in keys if key not in failed]
+            manifest, digest_errors = verify.record_digests(
+                root,
+                digest_keys,
+                new_prefix,
+                [current_prefix, *history_prefixes],
+                digests=digests,
             )
+            # other hardlinks have the same contents
+            for key, file_spec in zip(keys, file_specs):
+                if key in manifest.files:
+                    for path in file_spec.hardlinks:
+                        link_key = path.relative_to(root).as_posix()
+                        manifest.files[link_key] = manifest.files[key]
+            errors.extend(digest_errors)
+            try:
+                manifest.save(digests_path)
+            except OSError as e:
+                logger.warning(f"Could not write digests {digests_path}: {e!r}")
+    return errors
@@ -29,10 +29,21 @@ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
+import contextlib
+import dataclasses
+import errno
+import functools
+import hashlib
+import mmap
 import os
+import pathlib
 import re
+import shutil
 import sys
 import stat
+import tempfile
+import time
+import typing
 
 
 on_win = bool(sys.platform == "win32")
@@ -63,6 +74,22 @@ def exp_backoff_fn(fn, *args):
             return result
 
 
+def relink(path: str, hardlinks: typing.Iterable[str]):
+    """
+    Make `hardlinks` hardlinks of `path` again, after `path` was replaced by a
+    new file.
+    """
+    st = os.stat(path)
+    for link in hardlinks:
+        link_st = os.stat(link)
+        if (link_st.st_dev, link_st.st_ino) == (st.st_dev, st.st_ino):
+            continue
+        dirname, basename = os.path.split(link)
+        tmp_link = os.path.join(dirname, f".{basename}.{os.getpid()}.link")
+        os.link(path, tmp_link)
+        exp_backoff_fn(os.replace, tmp_link, link)
+
+
 class PaddingError(Exception):
     pass
 
@@ -71,22 +98,9 @@ class PlaceholderLenghtError(Exception):
     pass
 
 
-def binary_replace(
-    data: bytes,
-    original_placeholder: bytes,
-    current_placeholder: bytes,
-    new_placeholder: bytes,
+def check_placeholder_lengths(
+    original_placeholder: bytes, current_placeholder: bytes, new_placeholder: bytes
 ):
-    """
-    Perform a binary replacement of `data`, where the placeholder
-    `current_placeholder` is replaced with `new_placeholder` (terminated with a
-    single b"\0) and the remaining string is kept untouched.
-    `new_placeholder` may not be longer than `original_placeholder`.
-    All input arguments are expected to be bytes objects.
-    |-----------------------original placeholder-----------------|somestring?|0|
-    |--------current placeholder--------|somestring?|00000000000000000000000000|
-    |------------new placeholder--------------|somestr?|00000000000000000000000|
-    """
     if len(new_placeholder) > len(original_placeholder):
         raise PlaceholderLenghtError(
             f"New placeholder longer (lenght: {len(new_placeholder)}) than "
@@ -100,61 +114,875 @@ def binary_replace(
     assert padding_current >= 0
     assert padding_new >= 0
 
-    def replace(match):
+
+class PrefixMatcher:
+    """
+    Search for several prefixes in a single pass. Matches are leftmost-longest
+    and non-overlapping, as those of an Aho-Corasick automaton, but found with
+    one substring search per prefix: the next occurrence of every prefix is
+    remembered and only searched again once the scan passed it.
+    """
+
+    def __init__(self, prefixes: typing.Iterable[bytes]):
+        # longest first, so that the longest prefix wins at the same position
+        self.prefixes = tuple(sorted(set(prefixes), key=len, reverse=True))
+        if not self.prefixes or not self.prefixes[-1]:
+            raise ValueError("Need at least one non-empty prefix")
+        self.max_len = len(self.prefixes[0])
+
+    def searcher(
+        self, data, end: typing.Optional[int] = None
+    ) -> typing.Callable[[int], typing.Tuple[int, bytes]]:
+        """
+        Returns find(pos) -> (start, prefix) of the next match at or after
+        `pos` in `data[:end]`, (-1, b"") if there is none. `pos` must not
+        decrease between calls.
+        """
+        end = len(data) if end is None else end
+        prefixes = self.prefixes
+        if len(prefixes) == 1:
+            (prefix,) = prefixes
+
+            def find_single(pos: int) -> typing.Tuple[int, bytes]:
+                start = data.find(prefix, pos, end)
+                return start, prefix if start != -1 else b""
+
+            return find_single
+
+        upcoming = [-2] * len(prefixes)
+
+        def find(pos: int) -> typing.Tuple[int, bytes]:
+            best, best_prefix = -1, b""
+            for i, prefix in enumerate(prefixes):
+                start = upcoming[i]
+                if start == -2 or -1 < start < pos:
+                    start = upcoming[i] = data.find(prefix, pos, end)
+                if start != -1 and (best == -1 or start < best):
+                    best, best_prefix = start, prefix
+            return best, best_prefix
+
+        return find
+
+    def match(self, data, pos: int = 0) -> typing.Optional[bytes]:
+        """The longest prefix starting at `pos`"""
+        for prefix in self.prefixes:
+            if data[pos : pos + len(prefix)] == prefix:
+                return prefix
+        return None
+
+    def split(
+        self, data: bytes, counts: typing.Optional[typing.Dict[bytes, int]] = None
+    ) -> typing.List[bytes]:
         """
-        replace `current_placeholder` with `new_placeholder` and make sure the
-        resulting bytes have the same length (padded with \0)
+        Split `data` at all matches. The number of matches of every prefix is
+        added to `counts`, if given.
         """
-        matchstr = match.group().rstrip(b"\0")
-        result = matchstr.replace(current_placeholder, new_placeholder)
-        result = result + b"\0" * (len(match.group()) - len(result))
-        assert len(result) == len(match.group())
-        return result
+        if len(self.prefixes) == 1:
+            parts = data.split(self.prefixes[0])
+            if counts is not None:
+                counts[self.prefixes[0]] = (
+                    counts.get(self.prefixes[0], 0) + len(parts) - 1
+                )
+            return parts
+        parts = []
+        find = self.searcher(data)
+        pos = 0
+        start, prefix = find(0)
+        while start != -1:
+            parts.append(data[pos:start])
+            if counts is not None:
+                counts[prefix] = counts.get(prefix, 0) + 1
+            pos = start + len(prefix)
+            start, prefix = find(pos)
+        parts.append(data[pos:])
+        return parts
+
+    @staticmethod
+    def changes(counts: typing.Dict[bytes, int], new: bytes) -> int:
+        """Number of matches in `counts` that replacing with `new` changes"""
+        return sum(n for prefix, n in counts.items() if prefix != new)
+
+    def replace(self, data: bytes, new: bytes) -> bytes:
+        if len(self.prefixes) == 1:
+            return data.replace(self.prefixes[0], new)
+        return new.join(self.split(data))
+
+    def count(self, data: bytes) -> int:
+        if len(self.prefixes) == 1:
+            return data.count(self.prefixes[0])
+        return len(self.split(data)) - 1
+
+
+Prefixes = typing.Union[bytes, PrefixMatcher]
+
+
+def as_matcher(prefixes: Prefixes) -> PrefixMatcher:
+    if isinstance(prefixes, PrefixMatcher):
+        return prefixes
+    return PrefixMatcher([prefixes])
+
+
+def check_prefix_lengths(
+    original_placeholder: bytes, current_placeholders: Prefixes, new_placeholder: bytes
+):
+    for current_placeholder in as_matcher(current_placeholders).prefixes:
+        check_placeholder_lengths(
+            original_placeholder, current_placeholder, new_placeholder
+        )
+
+
+def replace_slot(slot: bytes, current_placeholder: Prefixes, new_placeholder: bytes):
+    """
+    replace `current_placeholder` with `new_placeholder` in a single
+    placeholder slot (placeholder, remaining string and all trailing \0s) and
+    make sure the resulting bytes have the same length (padded with \0)
+    """
+    matchstr = slot.rstrip(b"\0")
+    result = as_matcher(current_placeholder).replace(matchstr, new_placeholder)
+    result = result + b"\0" * (len(slot) - len(result))
+    assert len(result) == len(slot)
+    return result
+
+
+Slot = typing.Tuple[int, int]
+
+# trailing \0s of a placeholder slot are skipped in pieces of this size
+NULL_RUN_CHUNK = 256
 
+
+def slot_pattern(current_placeholder: Prefixes):
     # find the string including all trailing \0s
-    pat = re.compile(re.escape(current_placeholder) + b"([^\0]*?)\0+")
-    res = pat.sub(replace, data)
+    prefixes = b"|".join(map(re.escape, as_matcher(current_placeholder).prefixes))
+    return re.compile(b"(?:" + prefixes + b")([^\0]*?)\0+")
+
+
+def find_slots(data, current_placeholder: Prefixes) -> typing.List[Slot]:
+    """
+    (start, end) of all placeholder slots in `data` (bytes-like or mmap): the
+    placeholder, the remaining string and all trailing \0s. Same matches as
+    `slot_pattern`, but found with plain substring searches.
+    """
+    slots = []
+    size = len(data)
+    find = as_matcher(current_placeholder).searcher(data)
+    pos, prefix = find(0)
+    while pos != -1:
+        end = data.find(b"\0", pos + len(prefix))
+        if end == -1:
+            # no terminating \0 for this or any later occurrence
+            break
+        while end < size:
+            zeros = data[end : end + NULL_RUN_CHUNK]
+            n_zeros = len(zeros) - len(zeros.lstrip(b"\0"))
+            end += n_zeros
+            if n_zeros < len(zeros):
+                break
+        slots.append((pos, end))
+        pos, prefix = find(end)
+    return slots
+
+
+def binary_replace(
+    data: bytes,
+    original_placeholder: bytes,
+    current_placeholder: Prefixes,
+    new_placeholder: bytes,
+):
+    """
+    Perform a binary replacement of `data`, where the placeholder
+    `current_placeholder` is replaced with `new_placeholder` (terminated with a
+    single b"\0) and the remaining string is kept untouched.
+    `new_placeholder` may not be longer than `original_placeholder`.
+    All input arguments are expected to be bytes objects, `current_placeholder`
+    can also be a `PrefixMatcher` for several current placeholders.
+    |-----------------------original placeholder-----------------|somestring?|0|
+    |--------current placeholder--------|somestring?|00000000000000000000000000|
+    |------------new placeholder--------------|somestr?|00000000000000000000000|
+    """
+    check_prefix_lengths(original_placeholder, current_placeholder, new_placeholder)
+    matcher = as_matcher(current_placeholder)
+
+    view = memoryview(data)
+    parts = []
+    pos = 0
+    find = matcher.searcher(data)
+    start, prefix = find(0)
+    while start != -1:
+        # end of the string the placeholder is part of
+        string_end = data.find(b"\0", start + len(prefix))
+        if string_end == -1:
+            # no terminating \0 for this or any later occurrence
+            break
+        result = matcher.replace(data[start:string_end], new_placeholder)
+        parts.append(view[pos:start])
+        if len(result) > string_end - start:
+            # result has to fit into the trailing \0s of the slot
+            pos = start + len(result)
+            assert data.count(b"\0", string_end, pos) == pos - string_end
+            parts.append(result)
+        else:
+            pos = string_end
+            parts.append(result.ljust(string_end - start, b"\0"))
+        start, prefix = find(string_end)
+    parts.append(view[pos:])
+    res = b"".join(parts)
 
     assert new_placeholder in res
     assert len(res) == len(data)
     return res
 
 
-def update_prefix(
-    path: str, original_prefix: str, current_prefix: str, new_prefix: str, mode: str
+def binary_replace_regex(
+    data: bytes,
+    original_placeholder: bytes,
+    current_placeholder: Prefixes,
+    new_placeholder: bytes,
 ):
+    """
+    Regex based implementation of `binary_replace`, as in conda/constructor.
+    Kept as reference for testing and benchmarks.
+    """
+    check_prefix_lengths(original_placeholder, current_placeholder, new_placeholder)
+
+    def replace(match):
+        return replace_slot(match.group(), current_placeholder, new_placeholder)
+
+    res = slot_pattern(current_placeholder).sub(replace, data)
+
+    assert new_placeholder in res
+    assert len(res) == len(data)
+    return res
+
+
+def valid_slots(data, slots: typing.List[Slot], current_placeholder: Prefixes) -> bool:
+    """
+    Check that `slots` (e.g. recorded during a previous relocation) are still
+    placeholder slots in `data`: starting with `current_placeholder`, followed
+    by non-null bytes and terminated by all of the \0s up to `end`.
+    """
+    matcher = as_matcher(current_placeholder)
+    for start, end in slots:
+        if end > len(data):
+            return False
+        slot = data[start:end]
+        stripped = slot.rstrip(b"\0")
+        if (
+            matcher.match(slot) is None
+            or len(stripped) == len(slot)
+            or b"\0" in stripped
+            or (end < len(data) and data[end : end + 1] == b"\0")
+        ):
+            return False
+    return True
+
+
+@dataclasses.dataclass
+class UpdateStats:
+    """What happened while updating the prefix of a single file"""
+
+    modified: bool = False
+    bytes_read: int = 0
+    bytes_written: int = 0
+    # replaced occurrences (placeholder slots for binary files)
+    matches: int = 0
+    # slots of binary files patched in place
+    slots: typing.Optional[typing.List[Slot]] = None
+    # of the result, if requested (see `OutputDigest`)
+    digest: typing.Optional["Digest"] = None
+    # seconds spent per step ("read", "replace", "write")
+    timings: typing.Dict[str, float] = dataclasses.field(
+        default_factory=lambda: {"read": 0.0, "replace": 0.0, "write": 0.0}
+    )
+
+    def merge(self, other: "UpdateStats"):
+        """Add the stats of another pass over the same file"""
+        self.modified = self.modified or other.modified
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.matches += other.matches
+        if other.slots is not None:
+            self.slots = sorted(set(self.slots or []) | set(other.slots))
+        for step, seconds in other.timings.items():
+            self.timings[step] = self.timings.get(step, 0.0) + seconds
+
+
+# (sha256, size, occurrences of the new prefix, occurrences of other prefixes)
+Digest = typing.Tuple[str, int, int, int]
+
+
+class OutputDigest:
+    """
+    Digest of data passed in pieces to `update`, e.g. the result of a
+    relocation while it is written. Prefixes are counted leftmost-longest, so
+    stale prefixes that are part of the new one are not counted.
+    """
+
+    def __init__(self, new_prefix: bytes, stale_prefixes: typing.Iterable[bytes] = ()):
+        self.new_prefix = new_prefix
+        self.matcher = PrefixMatcher([new_prefix, *stale_prefixes])
+        self.counts = dict.fromkeys(self.matcher.prefixes, 0)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.carry = b""
+
+    def _count(self, data, final: bool) -> bytes:
+        """
+        Count the prefixes in `data`, returns the tail that could still be the
+        start of a prefix continued in the next piece.
+        """
+        matcher = self.matcher
+        find = matcher.searcher(data)
+        last_start = len(data) if final else len(data) - matcher.max_len
+        end = 0
+        start, prefix = find(0)
+        while -1 < start <= last_start:
+            self.counts[prefix] += 1
+            end = start + len(prefix)
+            start, prefix = find(end)
+        if final:
+            return b""
+        return bytes(data[max(end, len(data) - matcher.max_len + 1) :])
+
+    def update(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.carry = self._count(
+            self.carry + bytes(data) if self.carry else data, final=False
+        )
+
+    def result(self) -> Digest:
+        self.carry = self._count(self.carry, final=True)
+        occurrences = self.counts[self.new_prefix]
+        return (
+            self.sha256.hexdigest(),
+            self.size,
+            occurrences,
+            sum(self.counts.values()) - occurrences,
+        )
+
+
+def output_digest(
+    new_prefix: bytes, current_prefix: Prefixes, digest: bool
+) -> typing.Optional[OutputDigest]:
+    """`OutputDigest` counting `current_prefix` as stale, if `digest`"""
+    if not digest:
+        return None
+    stale = [p for p in as_matcher(current_prefix).prefixes if p != new_prefix]
+    return OutputDigest(new_prefix, stale)
+
+
+class DigestWriter:
+    """Writes to `fo`, passing everything written to `digest`"""
+
+    def __init__(self, fo: typing.BinaryIO, digest: OutputDigest):
+        self.fo = fo
+        self.digest = digest
+
+    def write(self, data) -> int:
+        self.digest.update(data)
+        return self.fo.write(data)
+
+
+def binary_replace_inplace(
+    path: str,
+    original_placeholder: bytes,
+    current_placeholder: Prefixes,
+    new_placeholder: bytes,
+    slots: typing.Optional[typing.List[Slot]] = None,
+    digest: bool = False,
+) -> UpdateStats:
+    """
+    Same replacement as `binary_replace`, but the file at `path` is memory
+    mapped and only the bytes of the affected placeholder slots are written.
+    This is possible since binary replacement never changes the file length.
+    Processes that map the file see the changes, see `update_prefix`.
+
+    If `slots` are given (and still valid), the file is not scanned for
+    occurrences, only the slots are read and patched.
+
+    With `digest`, the digest of the patched mapping is added to the stats
+    (which reads all of the file).
+    """
+    check_prefix_lengths(original_placeholder, current_placeholder, new_placeholder)
+    stats = UpdateStats(slots=[])
+    out_digest = output_digest(new_placeholder, current_placeholder, digest)
+    with open(path, "r+b") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            if out_digest is not None:
+                stats.digest = out_digest.result()
+            return stats
+        with mmap.mmap(f.fileno(), 0) as mm:
+            # reading happens implicitly (page faults) while scanning
+            t_start = time.perf_counter()
+            if slots is None or not valid_slots(mm, slots, current_placeholder):
+                slots = find_slots(mm, current_placeholder)
+                stats.bytes_read = size
+            else:
+                stats.bytes_read = sum(end - start for start, end in slots)
+            for start, end in slots:
+                slot = mm[start:end]
+                result = replace_slot(slot, current_placeholder, new_placeholder)
+                if result != slot:
+                    mm[start:end] = result
+                    stats.bytes_written += len(result)
+            t_replaced = time.perf_counter()
+            stats.timings["replace"] = t_replaced - t_start
+            if stats.bytes_written:
+                mm.flush()
+                stats.timings["write"] = time.perf_counter() - t_replaced
+            if out_digest is not None:
+                out_digest.update(mm)
+                stats.digest = out_digest.result()
+    stats.modified = stats.bytes_written > 0
+    stats.matches = len(slots)
+    stats.slots = [tuple(slot) for slot in slots]
+    return stats
+
+
+TEXT_CHUNK_SIZE = 1 << 20
+
+
+def split_chunk(
+    buf: bytes,
+    current_prefix: Prefixes,
+    final: bool,
+    counts: typing.Optional[typing.Dict[bytes, int]] = None,
+) -> typing.Tuple[typing.List[bytes], bytes]:
+    """
+    Split `buf` at all occurrences of `current_prefix`, counting them per
+    prefix in `counts` (see `PrefixMatcher.split`).
+
+    Unless this is the `final` chunk, the tail of `buf` that could be the start
+    of an occurrence continuing in the next chunk is not processed but returned
+    as carry (at most `len(current_prefix) - 1` bytes, of the longest prefix),
+    to be prepended to the next chunk.
+
+    Returns (parts between the occurrences, carry)
+    """
+    matcher = as_matcher(current_prefix)
+    if final:
+        return matcher.split(buf, counts), b""
+    # scan non-overlapping occurrences from the left, like bytes.split does.
+    # Occurrences closer than the longest prefix to the end of the chunk could
+    # be part of a longer one continuing in the next chunk.
+    last_start = len(buf) - matcher.max_len
+    end_of_last = 0
+    find = matcher.searcher(buf)
+    pos, prefix = find(0)
+    while -1 < pos <= last_start:
+        end_of_last = pos + len(prefix)
+        pos, prefix = find(end_of_last)
+    cut = max(end_of_last, len(buf) - (matcher.max_len - 1))
+    return matcher.split(buf[:cut], counts), buf[cut:]
+
+
+def replace_chunk(
+    buf: bytes, current_prefix: Prefixes, new_prefix: bytes, final: bool
+) -> typing.Tuple[bytes, bytes, int]:
+    """
+    Replace all occurrences of `current_prefix` in `buf`, see `split_chunk`.
+
+    Returns (replaced bytes, carry, number of replacements)
+    """
+    parts, carry = split_chunk(buf, current_prefix, final)
+    return new_prefix.join(parts), carry, len(parts) - 1
+
+
+def replace_stream(
+    fi: typing.BinaryIO,
+    fo: typing.BinaryIO,
+    current_prefix: Prefixes,
+    new_prefix: bytes,
+    chunk_size: int = TEXT_CHUNK_SIZE,
+) -> UpdateStats:
+    """
+    Copy `fi` to `fo` in chunks of `chunk_size` bytes, replacing all
+    occurrences of `current_prefix` with `new_prefix` on the way.
+    """
+    return replace_stream_many(fi, [(fo, new_prefix)], current_prefix, chunk_size)
+
+
+def replace_stream_many(
+    fi: typing.BinaryIO,
+    targets: typing.Sequence[typing.Tuple[typing.BinaryIO, bytes]],
+    current_prefix: Prefixes,
+    chunk_size: int = TEXT_CHUNK_SIZE,
+    carry: bytes = b"",
+) -> UpdateStats:
+    """
+    `replace_stream` to several outputs: every chunk of `fi` is read and
+    searched once, and written to each (output, new prefix) of `targets`.
+    `carry` are bytes already read from `fi`, that are processed first.
+    """
+    current_prefix = as_matcher(current_prefix)
+    stats = UpdateStats()
+    timings = stats.timings
+    counts: typing.Dict[bytes, int] = {}
+    while True:
+        t_start = time.perf_counter()
+        chunk = fi.read(chunk_size)
+        t_read = time.perf_counter()
+        parts, carry = split_chunk(
+            carry + chunk, current_prefix, final=not chunk, counts=counts
+        )
+        t_replaced = time.perf_counter()
+        for fo, new_prefix in targets:
+            t_joined = time.perf_counter()
+            out = new_prefix.join(parts)
+            t_replaced += time.perf_counter() - t_joined
+            fo.write(out)
+            stats.bytes_written += len(out)
+        timings["read"] += t_read - t_start
+        timings["replace"] += t_replaced - t_read
+        timings["write"] += time.perf_counter() - t_replaced
+        stats.bytes_read += len(chunk)
+        stats.matches += len(parts) - 1
+        if not chunk:
+            break
+    # replacing a prefix by itself does not change anything
+    stats.modified = any(
+        PrefixMatcher.changes(counts, new_prefix) for _, new_prefix in targets
+    )
+    return stats
+
+
+def _copy_head(path: str, fo: typing.BinaryIO, size: int, chunk_size: int):
+    """
+    Copy the first `size` bytes of `path` to `fo`, in kernel with
+    copy_file_range where supported.
+    """
+    fo.flush()
+    copied = 0
+    with open(path, "rb") as fi:
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fi.fileno(), fo.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as e:
+                if e.errno not in (
+                    errno.EXDEV,
+                    errno.ENOSYS,
+                    errno.EOPNOTSUPP,
+                    errno.EINVAL,
+                ):
+                    raise
+        fi.seek(copied)
+        while copied < size:
+            chunk = fi.read(min(chunk_size, size - copied))
+            if not chunk:
+                raise EOFError(f"{path} changed while it was relocated")
+            fo.write(chunk)
+            copied += len(chunk)
+
+
+def stream_text_replace(
+    path: str,
+    current_prefix: Prefixes,
+    new_prefix: bytes,
+    chunk_size: int = TEXT_CHUNK_SIZE,
+    digest: bool = False,
+) -> UpdateStats:
+    """
+    Text replacement of `current_prefix` with `new_prefix` processing the file
+    in chunks of `chunk_size` bytes. With `digest`, the digest of the result
+    is computed on the way and added to the stats.
+
+    The file is only read until the first chunk with an occurrence that
+    changes. From there on the result is written to a temporary file next to
+    `path` (starting with a copy of the unchanged bytes before that chunk),
+    that is atomically renamed to `path` afterwards. Files that do not change
+    are only read.
+    """
+    current_prefix = as_matcher(current_prefix)
+    stats = UpdateStats()
+    out_digest = output_digest(new_prefix, current_prefix, digest)
+    counts: typing.Dict[bytes, int] = {}
+    # offset in the file of the chunk being searched
+    offset = 0
+    carry = b""
+    with open(path, "rb") as fi:
+        while True:
+            t_start = time.perf_counter()
+            chunk = fi.read(chunk_size)
+            t_read = time.perf_counter()
+            buf = carry + chunk
+            parts, carry = split_chunk(
+                buf, current_prefix, final=not chunk, counts=counts
+            )
+            stats.timings["read"] += t_read - t_start
+            stats.timings["replace"] += time.perf_counter() - t_read
+            stats.bytes_read += len(chunk)
+            stats.matches = sum(counts.values())
+            if PrefixMatcher.changes(counts, new_prefix):
+                break
+            if out_digest is not None:
+                # unchanged, the same as the result
+                out_digest.update(buf[: len(buf) - len(carry)])
+            if not chunk:
+                if out_digest is not None:
+                    stats.digest = out_digest.result()
+                return stats
+            offset += len(buf) - len(carry)
+
+        st = os.lstat(path)
+        dirname, basename = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{basename}.", dir=dirname)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                t_start = time.perf_counter()
+                _copy_head(path, f, offset, chunk_size)
+                fo = f if out_digest is None else DigestWriter(f, out_digest)
+                out = new_prefix.join(parts)
+                fo.write(out)
+                stats.timings["write"] += time.perf_counter() - t_start
+                stats.bytes_written += offset + len(out)
+                stats.merge(
+                    replace_stream_many(
+                        fi, [(fo, new_prefix)], current_prefix, chunk_size, carry
+                    )
+                )
+            if out_digest is not None:
+                stats.digest = out_digest.result()
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+            exp_backoff_fn(os.replace, tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+    stats.modified = True
+    return stats
+
+
+def copy_binary_replace(
+    source: str,
+    destination: str,
+    original_placeholder: bytes,
+    current_placeholder: Prefixes,
+    new_placeholder: bytes,
+) -> UpdateStats:
+    """
+    Copy `source` to `destination` doing the replacement of `binary_replace`
+    on the way. The source is memory mapped and written out in slices, so it
+    is read only once and never held in memory as a whole.
+    """
+    return copy_binary_replace_many(
+        source,
+        [(destination, new_placeholder)],
+        original_placeholder,
+        current_placeholder,
+    )
+
+
+def copy_binary_replace_many(
+    source: str,
+    targets: typing.Sequence[typing.Tuple[str, bytes]],
+    original_placeholder: bytes,
+    current_placeholder: Prefixes,
+) -> UpdateStats:
+    """
+    `copy_binary_replace` to several (destination, new placeholder)
+    `targets`: the placeholder slots are located once and shared by all
+    destinations.
+    """
+    current_placeholder = as_matcher(current_placeholder)
+    for _, new_placeholder in targets:
+        check_prefix_lengths(original_placeholder, current_placeholder, new_placeholder)
+    stats = UpdateStats(slots=[])
+    with open(source, "rb") as fi, contextlib.ExitStack() as stack:
+        outputs = [
+            (stack.enter_context(open(destination, "wb")), new_placeholder)
+            for destination, new_placeholder in targets
+        ]
+        if os.fstat(fi.fileno()).st_size == 0:
+            return stats
+        with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            t_start = time.perf_counter()
+            stats.slots = find_slots(mm, current_placeholder)
+            stats.timings["replace"] = time.perf_counter() - t_start
+            t_start = time.perf_counter()
+            view = memoryview(mm)
+            try:
+                for fo, new_placeholder in outputs:
+                    pos = 0
+                    for start, end in stats.slots:
+                        fo.write(view[pos:start])
+                        slot = mm[start:end]
+                        result = replace_slot(
+                            slot, current_placeholder, new_placeholder
+                        )
+                        fo.write(result)
+                        stats.modified = stats.modified or result != slot
+                        pos = end
+                    fo.write(view[pos:])
+            finally:
+                view.release()
+            stats.timings["write"] = time.perf_counter() - t_start
+            stats.bytes_read = len(mm)
+            stats.bytes_written = len(mm) * len(outputs)
+    stats.matches = len(stats.slots)
+    return stats
+
+
+def fast_copy(source: str, destination: str):
+    """
+    Copy file contents with copy_file_range (in kernel, reflinks or server
+    side copies where supported), otherwise with shutil.copyfile (which uses
+    sendfile on linux).
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source, "rb") as fi, open(destination, "wb") as fo:
+                remaining = os.fstat(fi.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fi.fileno(), fo.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            return
+        except OSError as e:
+            if e.errno not in (
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EOPNOTSUPP,
+                errno.EINVAL,
+            ):
+                raise
+    shutil.copyfile(source, destination)
+
+
+@functools.lru_cache(maxsize=1)
+def mapped_files() -> typing.FrozenSet[str]:
+    """
+    Files mapped into the memory of any process whose maps can be read (all
+    processes of the same user, all processes when running as root), e.g. a
+    running ilastik session or python itself when relocating from within the
+    install. Mappings of other users' processes can not be seen. Only
+    available on linux, empty otherwise.
+    """
+    proc = pathlib.Path("/proc")
+    if not (proc / "self" / "maps").exists():
+        return frozenset()
+    paths = set()
+    for maps in proc.glob("[0-9]*/maps"):
+        try:
+            with maps.open("r") as f:
+                for line in f:
+                    fields = line.split(maxsplit=5)
+                    if len(fields) == 6 and fields[5].startswith("/"):
+                        paths.add(fields[5].rstrip("\n"))
+        except OSError:
+            # process exited, or maps of another user
+            continue
+    return frozenset(paths)
+
+
+def update_prefix(
+    path: str,
+    original_prefix: str,
+    current_prefix: typing.Union[str, typing.Sequence[str]],
+    new_prefix: str,
+    mode: str,
+    inplace: bool = False,
+    slots: typing.Optional[typing.List[Slot]] = None,
+    digest: bool = False,
+) -> UpdateStats:
+    """
+    Binary files are unlinked and rewritten, so that processes that have them
+    mapped (e.g. a running ilastik session) keep the old contents.
+
+    With `inplace` binary files are patched in place instead. This is only
+    safe if no process maps the file: pages of a MAP_PRIVATE mapping that were
+    not touched yet would change under the process. Files mapped by processes
+    visible in /proc (see `mapped_files`), running executables and files that
+    cannot be opened for writing are still rewritten, but mappings of other
+    users' processes can not be detected.
+
+    `slots` are known placeholder positions for in place patching, see
+    `binary_replace_inplace`.
+
+    `current_prefix` can also be a sequence of prefixes, all of them are
+    replaced in a single pass over the file.
+
+    With `digest`, the digest of the result (see `OutputDigest`) is computed
+    while it is written and added to the stats.
+    """
     if on_win:
         # force all prefix replacements to forward slashes to simplify need
         # to escape backslashes - replace with unix-style path separators
         new_prefix = new_prefix.replace("\\", "/")
+    if isinstance(current_prefix, str):
+        current_prefix = [current_prefix]
+    current = PrefixMatcher(prefix.encode("utf-8") for prefix in current_prefix)
 
     path = os.path.realpath(path)
-    with open(path, "rb") as fi:
-        data = fi.read()
+    if mode == "binary" and inplace and not on_win and path not in mapped_files():
+        try:
+            return binary_replace_inplace(
+                path,
+                original_prefix.encode("utf-8"),
+                current,
+                new_prefix.encode("utf-8"),
+                slots=slots,
+                digest=digest,
+            )
+        except OSError as e:
+            # e.g. ETXTBSY for running executables, or read-only files
+            if e.errno not in (errno.ETXTBSY, errno.EACCES, errno.EPERM):
+                raise
+
     if mode == "text":
-        new_data = data.replace(
-            current_prefix.encode("utf-8"), new_prefix.encode("utf-8")
+        return stream_text_replace(
+            path, current, new_prefix.encode("utf-8"), digest=digest
         )
-    elif mode == "binary":
+
+    stats = UpdateStats()
+    out_digest = output_digest(new_prefix.encode("utf-8"), current, digest)
+    t_start = time.perf_counter()
+    with open(path, "rb") as fi:
+        data = fi.read()
+    t_read = time.perf_counter()
+    stats.timings["read"] = t_read - t_start
+    stats.bytes_read = len(data)
+    if mode == "binary":
         if on_win:
             # anaconda-verify will not allow binary current_prefix on Windows.
             # However, since some packages might be created wrong (and a
             # binary current_prefix would break the package, we just skip here.
-            return
+            if out_digest is not None:
+                out_digest.update(data)
+                stats.digest = out_digest.result()
+            return stats
         new_data = binary_replace(
             data,
             original_prefix.encode("utf-8"),
-            current_prefix.encode("utf-8"),
+            current,
             new_prefix.encode("utf-8"),
         )
+        stats.matches = current.count(data)
     else:
         sys.exit("Invalid mode:" % mode)
+    t_replaced = time.perf_counter()
+    stats.timings["replace"] = t_replaced - t_read
 
     if new_data == data:
-        return
+        if out_digest is not None:
+            out_digest.update(data)
+            stats.digest = out_digest.result()
+        return stats
     st = os.lstat(path)
     # unlink in case the file is memory mapped
     exp_backoff_fn(os.unlink, path)
-    with open(path, "wb") as fo:
+    with open(path, "wb") as f:
+        fo = f if out_digest is None else DigestWriter(f, out_digest)
         fo.write(new_data)
     os.chmod(path, stat.S_IMODE(st.st_mode))
+    if out_digest is not None:
+        stats.digest = out_digest.result()
+    stats.timings["write"] = time.perf_counter() - t_replaced
+    stats.bytes_written = len(new_data)
+    stats.modified = True
+    return stats
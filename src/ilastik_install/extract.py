@@ -0,0 +1,306 @@
+"""
+Extract a release tarball and relocate it in the same streaming pass.
+
+The files that need relocation are known up front, either from a sidecar
+manifest next to the archive (`<archive>.relocation.json`, see
+`write_manifest`) or from a first pass over the archive that only reads
+conda-meta. The sidecar is ignored if the archive changed since it was
+written (size and mtime). Members are then relocated while they are written out, so that
+no file has to be read back from disk after extraction.
+"""
+
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import posixpath
+import shutil
+import tarfile
+import typing
+
+from ilastik_install import conda_meta, core
+from ilastik_install.external import _constructor
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 2
+MANIFEST_SUFFIX = ".relocation.json"
+
+# (package, relative path, file mode, prefix placeholder)
+ManifestEntry = typing.Tuple[str, str, str, str]
+# (size, mtime in ns) of an archive
+ArchiveStamp = typing.Tuple[int, int]
+
+
+def archive_stamp(archive_path: pathlib.Path) -> ArchiveStamp:
+    st = os.stat(archive_path)
+    return st.st_size, st.st_mtime_ns
+
+
+@dataclasses.dataclass
+class Manifest:
+    # top level directory of the install in the archive, "" if there is none
+    root: str
+    # prefix recorded in the prefix file of the archive
+    previous_prefix: str
+    entries: typing.List[ManifestEntry]
+    # of the archive the manifest was read from, see `archive_stamp`
+    archive: typing.Optional[ArchiveStamp] = None
+
+    def save(self, manifest_path: pathlib.Path):
+        placeholders: typing.Dict[str, int] = {}
+        files = []
+        for package, path, mode, placeholder in self.entries:
+            placeholder_id = placeholders.setdefault(placeholder, len(placeholders))
+            files.append([package, path, mode, placeholder_id])
+        with manifest_path.open("w") as f:
+            json.dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "root": self.root,
+                    "previous_prefix": self.previous_prefix,
+                    "archive": self.archive,
+                    "placeholders": list(placeholders),
+                    "files": files,
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, manifest_path: pathlib.Path) -> typing.Optional["Manifest"]:
+        """Returns None if there is no (readable) manifest at `manifest_path`"""
+        try:
+            with manifest_path.open("r") as f:
+                data = json.load(f)
+            if data.get("version") != MANIFEST_VERSION:
+                logger.warning(f"Ignoring outdated manifest {manifest_path}")
+                return None
+            placeholders = data["placeholders"]
+            entries = [
+                (package, path, mode, placeholders[placeholder_id])
+                for package, path, mode, placeholder_id in data["files"]
+            ]
+            archive = data["archive"]
+            return cls(
+                data["root"],
+                data["previous_prefix"],
+                entries,
+                None if archive is None else tuple(archive),
+            )
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+            logger.debug(f"Could not load manifest {manifest_path}: {e!r}")
+            return None
+
+
+def manifest_path(archive_path: pathlib.Path) -> pathlib.Path:
+    return archive_path.with_name(archive_path.name + MANIFEST_SUFFIX)
+
+
+def read_manifest(
+    archive_path: pathlib.Path, prefix_file: str = ".prefix_previous"
+) -> Manifest:
+    """
+    Collect the relocatable files from conda-meta and the previous prefix
+    from `prefix_file` in the archive, skipping over all other members.
+    """
+    logger.info(f"reading conda-meta from {archive_path}")
+    stamp = archive_stamp(archive_path)
+    entries = []
+    roots = set()
+    prefixes = {}
+    with tarfile.open(archive_path, "r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            path = pathlib.PurePosixPath(member.name)
+            if path.name == prefix_file:
+                prefixes[path.parent.as_posix()] = json.load(tar.extractfile(member))
+            elif path.parent.name == "conda-meta" and path.suffix == ".json":
+                roots.add(path.parent.parent.as_posix())
+                text = tar.extractfile(member).read().decode("utf-8")
+                for file_spec in conda_meta.iter_relocatable(text):
+                    entries.append(
+                        (
+                            path.stem,
+                            file_spec["_path"],
+                            file_spec["file_mode"],
+                            file_spec["prefix_placeholder"],
+                        )
+                    )
+    if len(roots) != 1:
+        raise ValueError(f"Expected a single conda-meta in {archive_path}")
+    (root,) = roots
+    if root not in prefixes:
+        raise ValueError(f"Could not find {prefix_file} in {archive_path}")
+    return Manifest(
+        "" if root == "." else root, prefixes[root]["previous_prefix"], entries, stamp
+    )
+
+
+def write_manifest(
+    archive_path: pathlib.Path, prefix_file: str = ".prefix_previous"
+) -> pathlib.Path:
+    """Write the sidecar manifest of `archive_path`, returns its path"""
+    path = manifest_path(archive_path)
+    read_manifest(archive_path, prefix_file).save(path)
+    return path
+
+
+def _extract_file(
+    fi: typing.BinaryIO,
+    target: pathlib.Path,
+    entry: typing.Optional[typing.Tuple[str, str]],
+    current_prefix: str,
+    new_prefix: str,
+):
+    with target.open("wb") as fo:
+        if entry is None or (entry[0] == "binary" and _constructor.on_win):
+            shutil.copyfileobj(fi, fo)
+        elif entry[0] == "text":
+            _constructor.replace_stream(
+                fi, fo, current_prefix.encode("utf-8"), new_prefix.encode("utf-8")
+            )
+        elif entry[0] == "binary":
+            # placeholder slots can be arbitrarily far apart, binaries are
+            # relocated in memory
+            fo.write(
+                _constructor.binary_replace(
+                    fi.read(),
+                    entry[1].encode("utf-8"),
+                    current_prefix.encode("utf-8"),
+                    new_prefix.encode("utf-8"),
+                )
+            )
+        else:
+            raise ValueError(f"Invalid mode: {entry[0]}")
+
+
+def extract_relocate(
+    archive_path: pathlib.Path,
+    destination: pathlib.Path,
+    new_prefix: pathlib.Path,
+    manifest: typing.Optional[Manifest] = None,
+    prefix_file: str = ".prefix_previous",
+) -> core.ResultDict:
+    """
+    Extract the install in `archive_path` to `destination`, replacing the
+    previous prefix of the archive with `new_prefix` on the way. The
+    manifest is read from the sidecar file, or from the archive if there is
+    none or it was written for a different version of the archive.
+
+    Members are refused if they would be written outside of `destination`,
+    also through symlinks (from the archive or already present), as are
+    symlinks and hardlinks pointing outside of it.
+
+    Returns a list of errors, one entry per member that could not be
+    extracted.
+    """
+    if manifest is None:
+        manifest = Manifest.load(manifest_path(archive_path))
+        if manifest is not None and manifest.archive != archive_stamp(archive_path):
+            logger.warning(
+                f"Ignoring manifest {manifest_path(archive_path)}, "
+                f"{archive_path} changed since it was written"
+            )
+            manifest = None
+    if manifest is None:
+        logger.info(f"No manifest found for {archive_path}, reading archive twice")
+        manifest = read_manifest(archive_path, prefix_file)
+    files = {
+        path: (mode, placeholder) for _, path, mode, placeholder in manifest.entries
+    }
+    current_prefix = manifest.previous_prefix
+    logger.info(
+        f"extracting {archive_path} to {destination}, updating prefix_path from "
+        f"{current_prefix} to {new_prefix.as_posix()}"
+    )
+
+    root = pathlib.PurePosixPath(manifest.root)
+    destination.mkdir(parents=True, exist_ok=True)
+    real_destination = os.path.realpath(destination)
+    errors = []
+    directories = []
+    extracted = set()
+
+    def relative(name: str) -> typing.Optional[pathlib.PurePosixPath]:
+        path = pathlib.PurePosixPath(name)
+        if path.is_absolute() or ".." in path.parts:
+            raise ValueError(f"Refusing to extract {name} outside of {destination}")
+        try:
+            return path.relative_to(root)
+        except ValueError:
+            return None
+
+    def checked(target: pathlib.Path) -> pathlib.Path:
+        """
+        `target`, if it does not resolve outside of `destination` through
+        symlinks (extracted before or already present).
+        """
+        real_target = os.path.realpath(target)
+        if os.path.commonpath([real_target, real_destination]) != real_destination:
+            raise ValueError(
+                f"Refusing to extract {target}, it resolves to {real_target} "
+                f"outside of {destination}"
+            )
+        return target
+
+    def check_symlink(relative_path: pathlib.PurePosixPath, linkname: str):
+        link = posixpath.normpath(
+            posixpath.join(relative_path.parent.as_posix(), linkname)
+        )
+        if posixpath.isabs(linkname) or link == ".." or link.startswith("../"):
+            raise ValueError(
+                f"Refusing to link {relative_path} to {linkname} outside of "
+                f"{destination}"
+            )
+
+    with tarfile.open(archive_path, "r|*") as tar:
+        for member in tar:
+            try:
+                relative_path = relative(member.name)
+                if relative_path is None:
+                    logger.warning(f"Ignoring {member.name} outside of {root}")
+                    continue
+                target = checked(destination / relative_path)
+                if member.isdir():
+                    target.mkdir(parents=True, exist_ok=True)
+                    directories.append((target, member))
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                extracted.add(relative_path.as_posix())
+                if member.issym():
+                    check_symlink(relative_path, member.linkname)
+                    os.symlink(member.linkname, target)
+                    continue
+                if member.islnk():
+                    link_source = relative(member.linkname)
+                    if link_source is None:
+                        raise ValueError(f"Link to {member.linkname} outside of {root}")
+                    # the linked member is relocated already
+                    os.link(checked(destination / link_source), target)
+                    continue
+                if not member.isfile():
+                    logger.warning(f"Ignoring special file {member.name}")
+                    continue
+                _extract_file(
+                    tar.extractfile(member),
+                    target,
+                    files.get(relative_path.as_posix()),
+                    current_prefix,
+                    new_prefix.as_posix(),
+                )
+                os.chmod(target, member.mode)
+                os.utime(target, (member.mtime, member.mtime))
+            except Exception as e:
+                logger.error(f"Could not extract {member.name}: {e!r}")
+                errors.append({"path": member.name, "error": repr(e)})
+
+    # deepest first, in case directories are read-only
+    for target, member in reversed(directories):
+        os.chmod(target, member.mode)
+        os.utime(target, (member.mtime, member.mtime))
+    for missing in sorted(set(files) - extracted):
+        logger.warning(f"Could not find {missing} in {archive_path}. ignoring.")
+    logger.info(f"extracted {archive_path}, {len(errors)} errors")
+    return errors
@@ -0,0 +1,98 @@
+"""
+Compact, cached relocation index compiled from conda-meta.
+
+Only files with a `prefix_placeholder` are stored. The index is invalidated
+whenever the mtimes or sizes of the json files in conda-meta change.
+"""
+
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import typing
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+
+# (package, relative path, file mode, prefix placeholder, sha256 or "")
+IndexEntry = typing.Tuple[str, str, str, str, str]
+
+
+def conda_meta_fingerprint(conda_meta_path: pathlib.Path) -> typing.List[typing.List]:
+    fingerprint = []
+    for json_file in sorted(conda_meta_path.glob("*.json")):
+        st = json_file.stat()
+        fingerprint.append([json_file.name, st.st_mtime_ns, st.st_size])
+    return fingerprint
+
+
+@dataclasses.dataclass
+class RelocationIndex:
+    fingerprint: typing.List[typing.List]
+    entries: typing.List[IndexEntry]
+
+    def save(self, index_path: pathlib.Path):
+        placeholders: typing.Dict[str, int] = {}
+        packages: typing.Dict[str, typing.List] = {}
+        for package, path, mode, placeholder, sha256 in self.entries:
+            placeholder_id = placeholders.setdefault(placeholder, len(placeholders))
+            packages.setdefault(package, []).append(
+                [path, mode, placeholder_id, sha256]
+            )
+        logger.debug(f"writing relocation index {index_path.as_posix()}")
+        tmp_path = index_path.with_name(index_path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "fingerprint": self.fingerprint,
+                    "placeholders": list(placeholders),
+                    "packages": packages,
+                },
+                f,
+            )
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path: pathlib.Path) -> typing.Optional["RelocationIndex"]:
+        """Returns None if there is no (readable) index at `index_path`"""
+        try:
+            with index_path.open("r") as f:
+                data = json.load(f)
+            if data["version"] != INDEX_VERSION:
+                return None
+            placeholders = data["placeholders"]
+            entries = [
+                (package, path, mode, placeholders[placeholder_id], sha256)
+                for package, files in data["packages"].items()
+                for path, mode, placeholder_id, sha256 in files
+            ]
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+            logger.debug(f"could not read relocation index {index_path}: {e!r}")
+            return None
+        return cls(fingerprint=data["fingerprint"], entries=entries)
+
+
+def load_or_build(
+    conda_meta_path: pathlib.Path,
+    index_path: pathlib.Path,
+    build: typing.Callable[[], typing.Iterable[IndexEntry]],
+) -> typing.List[IndexEntry]:
+    """
+    Returns the entries of the index at `index_path` if it matches the current
+    state of `conda_meta_path`. Otherwise the index is rebuilt with `build`.
+    """
+    fingerprint = conda_meta_fingerprint(conda_meta_path)
+    relocation_index = RelocationIndex.load(index_path)
+    if relocation_index is not None and relocation_index.fingerprint == fingerprint:
+        logger.debug(f"using relocation index {index_path.as_posix()}")
+        return relocation_index.entries
+
+    relocation_index = RelocationIndex(fingerprint=fingerprint, entries=list(build()))
+    try:
+        relocation_index.save(index_path)
+    except OSError as e:
+        logger.warning(f"Could not write relocation index {index_path}: {e!r}")
+    return relocation_index.entries
@@ -0,0 +1,103 @@
+"""
+Journal of relocated files, so that an interrupted relocation can be resumed.
+
+The journal is a json-lines file. Every relocation run appends a header with
+the prefix recorded in the prefix file ("from") and the prefix files are
+relocated to ("to"). For every file that was relocated successfully the new
+prefix is appended. The journal is removed once the prefix file is updated.
+
+Files that are not in the journal might have been (partially) relocated by
+an interrupted run, they can contain the original prefix as well as any of
+the "to" prefixes of previous runs, including the prefix they are relocated
+to now.
+"""
+
+import json
+import logging
+import pathlib
+import typing
+
+logger = logging.getLogger(__name__)
+
+
+class RelocationJournal:
+    def __init__(self, journal_path: pathlib.Path, from_prefix: str, to_prefix: str):
+        self.journal_path = journal_path
+        # prefix of each file relocated by previous runs
+        self.prefixes: typing.Dict[str, str] = {}
+        # "to" prefixes of previous runs
+        self.targets: typing.List[str] = []
+        self._read(from_prefix)
+        if self.prefixes or self.targets:
+            logger.info(
+                f"resuming relocation, {len(self.prefixes)} files were relocated already"
+            )
+            mode = "a"
+        else:
+            mode = "w"
+        self._file = journal_path.open(mode)
+        self._write({"from": from_prefix, "to": to_prefix})
+
+    def _read(self, from_prefix: str):
+        if not self.journal_path.exists():
+            return
+        with self.journal_path.open("r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # incomplete last line of an interrupted run
+                    continue
+                if "from" in entry:
+                    if entry["from"] != from_prefix:
+                        logger.warning(
+                            f"Ignoring journal {self.journal_path} of a relocation "
+                            f"from {entry['from']}"
+                        )
+                        self.prefixes.clear()
+                        self.targets.clear()
+                        return
+                    if entry["to"] not in self.targets:
+                        self.targets.append(entry["to"])
+                else:
+                    self.prefixes[entry["path"]] = entry["prefix"]
+
+    def _write(self, entry: typing.Dict[str, str]):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def source_prefixes(
+        self, key: str, current_prefix: str, new_prefix: str
+    ) -> typing.List[str]:
+        """
+        Prefixes that have to be replaced by `new_prefix` in the file `key`
+        (relative path), empty if it was relocated to `new_prefix` already.
+
+        When resuming, files that are not in the journal might have been
+        written before they were recorded. `new_prefix` is matched as well
+        (and replaced by itself), so that it is not relocated again if it
+        starts with one of the other prefixes.
+        """
+        if key in self.prefixes:
+            prefix = self.prefixes[key]
+            return [] if prefix == new_prefix else [prefix]
+        prefixes = [current_prefix] + [
+            target
+            for target in self.targets
+            if target != new_prefix and target != current_prefix
+        ]
+        if self.targets and new_prefix != current_prefix:
+            prefixes.append(new_prefix)
+        return prefixes
+
+    def record(self, key: str, prefix: str):
+        self._write({"path": key, "prefix": prefix})
+
+    def close(self):
+        self._file.close()
+
+
+def discard(journal_path: pathlib.Path):
+    if journal_path.exists():
+        logger.debug(f"removing journal {journal_path.as_posix()}")
+        journal_path.unlink()
@@ -0,0 +1,66 @@
+"""
+Byte offsets of the placeholder slots in binary files.
+
+The positions of prefixes in binary files do not change between relocations.
+They are recorded per file, together with size and mtime of the file after
+relocation, so that later relocations can patch the slots directly instead of
+scanning the whole file again.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import typing
+
+from ilastik_install.external import _constructor
+
+logger = logging.getLogger(__name__)
+
+OCCURRENCES_VERSION = 1
+
+# {"size": int, "mtime_ns": int, "slots": [[start, end], ...]}
+OccurrenceRecord = typing.Dict[str, typing.Any]
+
+
+def make_record(
+    path: pathlib.Path, slots: typing.List[_constructor.Slot]
+) -> OccurrenceRecord:
+    st = os.stat(path)
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "slots": [list(slot) for slot in slots],
+    }
+
+
+def guarded_slots(
+    path: pathlib.Path, record: typing.Optional[OccurrenceRecord]
+) -> typing.Optional[typing.List[_constructor.Slot]]:
+    """Slots of `record`, if the file did not change since it was recorded"""
+    if record is None:
+        return None
+    st = os.stat(path)
+    if st.st_size != record["size"] or st.st_mtime_ns != record["mtime_ns"]:
+        logger.debug(f"{path.as_posix()} changed, ignoring recorded occurrences")
+        return None
+    return [tuple(slot) for slot in record["slots"]]
+
+
+def load(occurrences_path: pathlib.Path) -> typing.Dict[str, OccurrenceRecord]:
+    try:
+        with occurrences_path.open("r") as f:
+            data = json.load(f)
+        if data["version"] == OCCURRENCES_VERSION:
+            return data["files"]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.debug(f"could not read occurrences {occurrences_path}: {e!r}")
+    return {}
+
+
+def save(occurrences_path: pathlib.Path, records: typing.Dict[str, OccurrenceRecord]):
+    logger.debug(f"writing occurrences {occurrences_path.as_posix()}")
+    tmp_path = occurrences_path.with_name(occurrences_path.name + ".tmp")
+    with tmp_path.open("w") as f:
+        json.dump({"version": OCCURRENCES_VERSION, "files": records}, f)
+    os.replace(tmp_path, occurrences_path)
@@ -0,0 +1,286 @@
+"""
+Pipelined relocation for filesystems with high latency per file (NFS, Lustre).
+
+Files are processed in three stages connected by bounded queues:
+
+* reader threads prefetch upcoming files from the work list,
+* worker threads do the replacement in memory,
+* writer threads persist the results: binary files are rewritten, or
+  patched in place (only the placeholder slots that changed) if their file
+  spec allows it, text files are written to a temporary file that is renamed
+  over the original.
+
+Many reads and writes are in flight at the same time this way, while the
+number of files held in memory is bounded by the queue depths.
+"""
+
+import dataclasses
+import errno
+import logging
+import os
+import queue
+import stat
+import tempfile
+import threading
+import time
+import typing
+
+from ilastik_install import schedule
+from ilastik_install.external import _constructor
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class PipelineConfig:
+    readers: int = 8
+    workers: int = 1
+    writers: int = 8
+    # maximum number of files waiting between two stages
+    queue_depth: int = 16
+
+    def __post_init__(self):
+        # a stage without threads never passes its sentinels on
+        for field in dataclasses.fields(self):
+            if getattr(self, field.name) < 1:
+                raise ValueError(f"{field.name} has to be at least 1")
+
+
+@dataclasses.dataclass
+class _Item:
+    n: int
+    file_spec: typing.Any
+    current_placeholders: typing.Sequence[str]
+    # estimated memory, see schedule.estimated_memory
+    cost: int = 0
+    # compute the digest of the result
+    digest: bool = False
+    start: float = 0.0
+    path: str = ""
+    data: bytes = b""
+    new_data: typing.Optional[bytes] = None
+    # (offset, bytes) to write in place, binary files only
+    patches: typing.List[typing.Tuple[int, bytes]] = dataclasses.field(
+        default_factory=list
+    )
+    stats: _constructor.UpdateStats = dataclasses.field(
+        default_factory=_constructor.UpdateStats
+    )
+    error: typing.Optional[str] = None
+
+
+# (position in the work list, stats, error, seconds)
+PipelineResult = typing.Tuple[
+    int, typing.Optional[_constructor.UpdateStats], typing.Optional[str], float
+]
+
+
+def _read(item: _Item, new_placeholder: str):
+    item.start = t_start = time.perf_counter()
+    item.path = os.path.realpath(item.file_spec.path)
+    with open(item.path, "rb") as f:
+        item.data = f.read()
+    item.stats.timings["read"] = time.perf_counter() - t_start
+    item.stats.bytes_read = len(item.data)
+
+
+def _replace(item: _Item, new_placeholder: str):
+    t_start = time.perf_counter()
+    new = new_placeholder.encode("utf-8")
+    current = _constructor.PrefixMatcher(
+        prefix.encode("utf-8") for prefix in item.current_placeholders
+    )
+    if item.file_spec.mode == "text":
+        counts: typing.Dict[bytes, int] = {}
+        parts = current.split(item.data, counts)
+        item.stats.matches = len(parts) - 1
+        # replacing a prefix by itself does not change anything
+        if current.changes(counts, new):
+            item.new_data = new.join(parts)
+    elif item.file_spec.mode == "binary":
+        if _constructor.on_win:
+            # see _constructor.update_prefix
+            return
+        original = item.file_spec.original_prefix.encode("utf-8")
+        _constructor.check_prefix_lengths(original, current, new)
+        buf = bytearray(item.data)
+        item.stats.slots = _constructor.find_slots(buf, current)
+        item.stats.matches = len(item.stats.slots)
+        for start, end in item.stats.slots:
+            result = _constructor.replace_slot(bytes(buf[start:end]), current, new)
+            if result != buf[start:end]:
+                buf[start:end] = result
+                item.patches.append((start, result))
+        if item.patches:
+            item.new_data = bytes(buf)
+    else:
+        raise ValueError(f"Invalid mode: {item.file_spec.mode}")
+    item.stats.timings["replace"] = time.perf_counter() - t_start
+
+
+def _rewrite(path: str, data: bytes):
+    """unlink and write, in case the file is memory mapped"""
+    st = os.lstat(path)
+    _constructor.exp_backoff_fn(os.unlink, path)
+    with open(path, "wb") as fo:
+        fo.write(data)
+    os.chmod(path, stat.S_IMODE(st.st_mode))
+
+
+def _digest(item: _Item, new_placeholder: str):
+    """Digest of the result, as it is written"""
+    current = _constructor.PrefixMatcher(
+        [prefix.encode("utf-8") for prefix in item.current_placeholders]
+    )
+    digest = _constructor.output_digest(new_placeholder.encode("utf-8"), current, True)
+    digest.update(item.data if item.new_data is None else item.new_data)
+    item.stats.digest = digest.result()
+
+
+def _write(item: _Item, new_placeholder: str):
+    if item.digest:
+        _digest(item, new_placeholder)
+    if item.new_data is None:
+        return
+    t_start = time.perf_counter()
+    if item.file_spec.mode == "text":
+        st = os.lstat(item.path)
+        dirname, basename = os.path.split(item.path)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{basename}.", dir=dirname)
+        try:
+            with os.fdopen(fd, "wb") as fo:
+                fo.write(item.new_data)
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+            _constructor.exp_backoff_fn(os.replace, tmp_path, item.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        item.stats.bytes_written = len(item.new_data)
+    elif not item.file_spec.inplace or item.path in _constructor.mapped_files():
+        _rewrite(item.path, item.new_data)
+        item.stats.bytes_written = len(item.new_data)
+        item.stats.slots = None
+    else:
+        try:
+            with open(item.path, "r+b", buffering=0) as f:
+                for offset, patch in item.patches:
+                    f.seek(offset)
+                    f.write(patch)
+            item.stats.bytes_written = sum(len(patch) for _, patch in item.patches)
+        except OSError as e:
+            if e.errno not in (errno.ETXTBSY, errno.EACCES, errno.EPERM):
+                raise
+            _rewrite(item.path, item.new_data)
+            item.stats.bytes_written = len(item.new_data)
+            item.stats.slots = None
+    _constructor.relink(item.path, item.file_spec.hardlinks)
+    item.stats.modified = True
+    item.stats.timings["write"] = time.perf_counter() - t_start
+
+
+def _run_stage(
+    step: typing.Callable[[_Item, str], None],
+    new_placeholder: str,
+    in_queue: queue.Queue,
+    out_queue: queue.Queue,
+    n_threads: int,
+    n_consumers: int,
+    release_data: bool = False,
+) -> typing.List[threading.Thread]:
+    """
+    Start `n_threads` threads applying `step` to the items of `in_queue`.
+    Once all of them received their None sentinel, `n_consumers` sentinels are
+    passed on to `out_queue`. With `release_data` file contents are dropped
+    after `step`.
+    """
+    remaining = [n_threads]
+    lock = threading.Lock()
+
+    def run():
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            if item.error is None:
+                try:
+                    step(item, new_placeholder)
+                except Exception as e:
+                    item.error = repr(e)
+            if item.error is not None or release_data:
+                # release memory as early as possible
+                item.data = item.new_data = b""
+                item.patches = []
+            out_queue.put(item)
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                for _ in range(n_consumers):
+                    out_queue.put(None)
+
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def relocate_pipelined(
+    file_specs: typing.Sequence[typing.Any],
+    current_placeholders: typing.Sequence[typing.Sequence[str]],
+    new_placeholder: str,
+    config: PipelineConfig,
+    costs: typing.Optional[typing.Sequence[int]] = None,
+    budget: typing.Optional[schedule.MemoryBudget] = None,
+    digest: bool = False,
+) -> typing.Iterator[PipelineResult]:
+    """
+    Relocate `file_specs` (see `core.FileSpec`),
+    replacing all of the respective `current_placeholders` with
+    `new_placeholder`. Results are yielded in the order of completion.
+
+    With a `budget`, readers wait until the estimated memory `costs` of a
+    file is admitted, it is released once the file is written.
+
+    With `digest`, writers add the digest of every result to its stats.
+    """
+    if costs is None:
+        costs = [0] * len(file_specs)
+    if budget is None:
+        budget = schedule.MemoryBudget()
+    logger.debug(
+        f"relocating {len(file_specs)} files in a pipeline with {config.readers} "
+        f"readers, {config.workers} workers and {config.writers} writers"
+    )
+    todo: queue.Queue = queue.Queue()
+    read: queue.Queue = queue.Queue(maxsize=config.queue_depth)
+    replaced: queue.Queue = queue.Queue(maxsize=config.queue_depth)
+    done: queue.Queue = queue.Queue()
+    for n, (file_spec, placeholders, cost) in enumerate(
+        zip(file_specs, current_placeholders, costs)
+    ):
+        todo.put(_Item(n, file_spec, placeholders, cost, digest))
+    for _ in range(config.readers):
+        todo.put(None)
+
+    def read_budgeted(item: _Item, new_placeholder: str):
+        budget.acquire(item.cost)
+        _read(item, new_placeholder)
+
+    _run_stage(
+        read_budgeted, new_placeholder, todo, read, config.readers, config.workers
+    )
+    _run_stage(
+        _replace, new_placeholder, read, replaced, config.workers, config.writers
+    )
+    _run_stage(
+        _write, new_placeholder, replaced, done, config.writers, 1, release_data=True
+    )
+
+    while True:
+        item = done.get()
+        if item is None:
+            break
+        budget.release(item.cost)
+        seconds = time.perf_counter() - item.start
+        stats = item.stats if item.error is None else None
+        yield item.n, stats, item.error, seconds
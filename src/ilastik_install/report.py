@@ -0,0 +1,123 @@
+"""
+Timings and statistics of a relocation run, written as json report.
+"""
+
+import contextlib
+import dataclasses
+import json
+import logging
+import pathlib
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+MODIFIED = "modified"
+UNCHANGED = "unchanged"
+MISSING = "missing"
+# relocated by a previous, interrupted run
+SKIPPED = "skipped"
+# hardlink or symlink of a file relocated under another path
+DEDUPLICATED = "deduplicated"
+# linked from the relocation cache
+CACHED = "cached"
+ERROR = "error"
+
+
+@dataclasses.dataclass
+class FileReport:
+    path: str
+    package: str
+    mode: str
+    status: str
+    seconds: float = 0.0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    matches: int = 0
+    timings: typing.Dict[str, float] = dataclasses.field(default_factory=dict)
+    error: typing.Optional[str] = None
+
+
+@dataclasses.dataclass
+class RelocationReport:
+    phases: typing.Dict[str, float] = dataclasses.field(default_factory=dict)
+    files: typing.List[FileReport] = dataclasses.field(default_factory=list)
+    info: typing.Dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def add_file(self, file_report: FileReport):
+        self.files.append(file_report)
+
+    def totals(self) -> typing.Dict[str, typing.Any]:
+        totals: typing.Dict[str, typing.Any] = {
+            "files": len(self.files),
+            MODIFIED: 0,
+            UNCHANGED: 0,
+            MISSING: 0,
+            SKIPPED: 0,
+            DEDUPLICATED: 0,
+            CACHED: 0,
+            ERROR: 0,
+            "seconds": 0.0,
+            "bytes_read": 0,
+            "bytes_written": 0,
+            "matches": 0,
+            "timings": {},
+        }
+        for f in self.files:
+            totals[f.status] += 1
+            totals["seconds"] += f.seconds
+            totals["bytes_read"] += f.bytes_read
+            totals["bytes_written"] += f.bytes_written
+            totals["matches"] += f.matches
+            for step, seconds in f.timings.items():
+                totals["timings"][step] = totals["timings"].get(step, 0.0) + seconds
+        return totals
+
+    def packages(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        packages: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        for f in self.files:
+            package = packages.setdefault(
+                f.package,
+                {"package": f.package, "files": 0, "seconds": 0.0, "bytes_read": 0},
+            )
+            package["files"] += 1
+            package["seconds"] += f.seconds
+            package["bytes_read"] += f.bytes_read
+        return list(packages.values())
+
+    def summary(self, top_n: int = 20) -> typing.Dict[str, typing.Any]:
+        return {
+            **self.info,
+            "phases": self.phases,
+            "totals": self.totals(),
+            "slowest_files": [
+                dataclasses.asdict(f)
+                for f in sorted(self.files, key=lambda f: f.seconds, reverse=True)[
+                    :top_n
+                ]
+            ],
+            "slowest_packages": sorted(
+                self.packages(), key=lambda p: p["seconds"], reverse=True
+            )[:top_n],
+            "files": [dataclasses.asdict(f) for f in self.files],
+        }
+
+    def save(self, report_path: pathlib.Path, top_n: int = 20):
+        logger.info(f"writing relocation report to {report_path.as_posix()}")
+        summary = self.summary(top_n)
+        with report_path.open("w") as f:
+            json.dump(summary, f, indent=2)
+        for name, seconds in summary["phases"].items():
+            logger.info(f"{name}: {seconds:.3f} s")
+        for f in summary["slowest_files"][:5]:
+            logger.info(f"slow file {f['path']}: {f['seconds']:.3f} s")
@@ -0,0 +1,156 @@
+"""
+Memory budgeted, size aware scheduling of relocation work.
+
+Files are stat'ed up front and handed out largest first, so that big
+libraries do not end up as a long tail on a single worker. Work is only
+admitted while the estimated memory of all files in flight stays below the
+budget, a file larger than the budget is relocated on its own.
+"""
+
+import concurrent.futures
+import logging
+import re
+import sys
+import threading
+import typing
+
+from ilastik_install.external import _constructor
+
+logger = logging.getLogger(__name__)
+
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text: str) -> int:
+    """Parse a size like 512M or 2G (powers of 1024) to bytes"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)I?B?\s*", text.upper())
+    if match is None:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def estimated_memory(
+    mode: str, size: int, pipelined: bool = False, inplace: bool = False
+) -> int:
+    """
+    Estimated peak memory needed to relocate a file of `size` bytes.
+
+    Text files are streamed in chunks. Binary files patched `inplace` are
+    only mapped, rewritten ones are held in memory together with a modified
+    copy. In the pipeline, files are read as a whole and held with the
+    modified copy and the patches.
+    """
+    if pipelined:
+        return 3 * size
+    if mode == "text":
+        return 2 * min(size, _constructor.TEXT_CHUNK_SIZE)
+    if inplace:
+        return size
+    return 2 * size
+
+
+def largest_first(costs: typing.Sequence[int]) -> typing.List[int]:
+    """Indices of `costs`, largest first (stable for equal costs)"""
+    return sorted(range(len(costs)), key=lambda n: -costs[n])
+
+
+def peak_rss() -> typing.Optional[int]:
+    """
+    Peak resident memory in bytes of this process or the largest of its
+    (finished) child processes, None where this is not available.
+
+    This is the peak of a single process, not of all workers together (which
+    is what the memory budget limits, see `MemoryBudget.peak`).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kB on linux, bytes on macos
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+class MemoryBudget:
+    """
+    Bookkeeping of the estimated memory in flight. Work is admitted while the
+    total stays below `limit` (no limit if None), or if nothing else is in
+    flight. `peak` is the largest total in flight. Safe to use from multiple
+    threads.
+    """
+
+    def __init__(self, limit: typing.Optional[int] = None):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def _admits(self, cost: int) -> bool:
+        return (
+            self.limit is None
+            or self.in_flight == 0
+            or self.in_flight + cost <= self.limit
+        )
+
+    def _add(self, cost: int):
+        self.in_flight += cost
+        self.peak = max(self.peak, self.in_flight)
+
+    def try_acquire(self, cost: int) -> bool:
+        with self._condition:
+            if not self._admits(cost):
+                return False
+            self._add(cost)
+            return True
+
+    def acquire(self, cost: int):
+        """Block until `cost` is admitted"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._admits(cost))
+            self._add(cost)
+
+    def release(self, cost: int):
+        with self._condition:
+            self.in_flight -= cost
+            self._condition.notify_all()
+
+
+def budgeted_map(
+    executor: concurrent.futures.Executor,
+    fn: typing.Callable,
+    costs: typing.Sequence[int],
+    budget: MemoryBudget,
+    *iterables: typing.Sequence,
+    max_pending: typing.Optional[int] = None,
+) -> typing.Iterator[typing.Tuple[int, typing.Any]]:
+    """
+    Submit `fn` for all work items (the elements of `iterables`) to
+    `executor` one at a time, largest cost first, as long as `budget` admits
+    them. With `max_pending` (e.g. the number of workers), at most that many
+    items are submitted at once, so that the budget only accounts for work
+    that is running.
+
+    Yields (index of the work item, result) in the order of completion.
+    """
+    order = largest_first(costs)
+    pending = {}
+    position = 0
+    while position < len(order) or pending:
+        while (
+            position < len(order)
+            and (max_pending is None or len(pending) < max_pending)
+            and budget.try_acquire(costs[order[position]])
+        ):
+            n = order[position]
+            pending[executor.submit(fn, *(args[n] for args in iterables))] = n
+            position += 1
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            n = pending.pop(future)
+            budget.release(costs[n])
+            yield n, future.result()
@@ -0,0 +1,258 @@
+"""
+Verification of relocated files against a manifest of digests.
+
+During a relocation the sha256, size and the number of occurrences of the
+new prefix of every relocated file are computed from the output as it is
+written (see `_constructor.OutputDigest`), and recorded in a digest manifest.
+Files that were not rewritten (cached or already relocated) are hashed. The
+install can be checked against it later without rewriting anything: files
+are hashed with large buffered reads by a pool of threads (hashlib and file
+reads release the GIL), largest first. Besides digest mismatches, remaining
+occurrences of the prefixes relocated from are reported.
+"""
+
+import concurrent.futures
+import dataclasses
+import functools
+import itertools
+import json
+import logging
+import os
+import pathlib
+import typing
+
+from ilastik_install import schedule
+from ilastik_install.external import _constructor
+
+logger = logging.getLogger(__name__)
+
+DIGESTS_VERSION = 1
+HASH_BUFFER_SIZE = 1 << 22
+
+
+@dataclasses.dataclass
+class FileDigest:
+    sha256: str
+    size: int
+    # occurrences of the new prefix
+    occurrences: int
+    # occurrences of prefixes that should have been replaced
+    stale: int = 0
+
+
+def digest_file(
+    path: pathlib.Path,
+    new_prefix: bytes,
+    stale_prefixes: typing.Sequence[bytes] = (),
+    buffer_size: int = HASH_BUFFER_SIZE,
+) -> FileDigest:
+    """
+    Digest of the file at `path`, reading it once. Prefixes are counted
+    leftmost-longest, so stale prefixes that are part of the new one are not
+    counted.
+    """
+    digest = _constructor.OutputDigest(new_prefix, stale_prefixes)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return FileDigest(*digest.result())
+
+
+@dataclasses.dataclass
+class DigestManifest:
+    new_prefix: str
+    # prefixes relocated from (current prefix and history)
+    stale_prefixes: typing.List[str]
+    # relative path -> digest after relocation
+    files: typing.Dict[str, FileDigest]
+
+    def save(self, manifest_path: pathlib.Path):
+        logger.debug(f"writing digests {manifest_path.as_posix()}")
+        tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(
+                {
+                    "version": DIGESTS_VERSION,
+                    "new_prefix": self.new_prefix,
+                    "stale_prefixes": self.stale_prefixes,
+                    "files": {
+                        path: [digest.sha256, digest.size, digest.occurrences]
+                        for path, digest in self.files.items()
+                    },
+                },
+                f,
+            )
+        os.replace(tmp_path, manifest_path)
+
+    @classmethod
+    def load(cls, manifest_path: pathlib.Path) -> typing.Optional["DigestManifest"]:
+        """Returns None if there is no (readable) manifest at `manifest_path`"""
+        try:
+            with manifest_path.open("r") as f:
+                data = json.load(f)
+            if data.get("version") != DIGESTS_VERSION:
+                logger.warning(f"Ignoring outdated digests {manifest_path}")
+                return None
+            files = {
+                path: FileDigest(sha256, size, occurrences)
+                for path, (sha256, size, occurrences) in data["files"].items()
+            }
+            return cls(data["new_prefix"], data["stale_prefixes"], files)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug(f"Could not load digests {manifest_path}: {e!r}")
+            return None
+
+
+def discard(manifest_path: pathlib.Path):
+    if manifest_path.exists():
+        logger.debug(f"removing digests {manifest_path.as_posix()}")
+        manifest_path.unlink()
+
+
+def _try_digest(
+    path: pathlib.Path, new_prefix: bytes, stale_prefixes: typing.List[bytes]
+) -> typing.Union[FileDigest, OSError]:
+    try:
+        return digest_file(path, new_prefix, stale_prefixes)
+    except OSError as e:
+        return e
+
+
+def _digest_all(
+    root: pathlib.Path,
+    keys: typing.Sequence[str],
+    sizes: typing.Sequence[int],
+    new_prefix: str,
+    stale_prefixes: typing.Sequence[str],
+    jobs: int,
+) -> typing.Iterator[typing.Tuple[int, typing.Union[FileDigest, OSError]]]:
+    """
+    Digests of the files `keys` (relative to `root`) with `jobs` threads (0
+    uses all cores), largest first. Yields (index, digest) or (index, error)
+    in the order of completion.
+    """
+    digest = functools.partial(
+        _try_digest,
+        new_prefix=new_prefix.encode("utf-8"),
+        stale_prefixes=[prefix.encode("utf-8") for prefix in stale_prefixes],
+    )
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(digest, root / keys[n]): n
+            for n in schedule.largest_first(sizes)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
+def record_digests(
+    root: pathlib.Path,
+    keys: typing.Sequence[str],
+    new_prefix: str,
+    stale_prefixes: typing.Sequence[str],
+    digests: typing.Optional[typing.Dict[str, FileDigest]] = None,
+    jobs: int = 0,
+) -> typing.Tuple[DigestManifest, typing.List[typing.Dict[str, str]]]:
+    """
+    Digest manifest of the relocated files `keys` (relative to `root`).
+    Expected `digests` computed during the relocation are taken as they are,
+    the remaining files are hashed with `jobs` threads (0 uses all cores).
+
+    Returns the manifest and a list of errors, one entry per file that could
+    not be read or still contains one of `stale_prefixes`.
+    """
+    stale_prefixes = [p for p in stale_prefixes if p != new_prefix]
+    digests = digests or {}
+    missing = [key for key in keys if key not in digests]
+    sizes = []
+    for key in missing:
+        try:
+            sizes.append(os.stat(root / key).st_size)
+        except OSError:
+            sizes.append(0)
+    files = {}
+    errors = []
+    results = _digest_all(root, missing, sizes, new_prefix, stale_prefixes, jobs)
+    known = ((key, digests[key]) for key in keys if key in digests)
+    for key, digest in itertools.chain(known, ((missing[n], d) for n, d in results)):
+        path = (root / key).as_posix()
+        if isinstance(digest, OSError):
+            errors.append({"path": path, "error": repr(digest)})
+            continue
+        if digest.stale:
+            errors.append(
+                {"path": path, "error": f"{digest.stale} stale prefix occurrences"}
+            )
+        files[key] = digest
+    for error in errors:
+        logger.error(f"Could not record digest of {error['path']}: {error['error']}")
+    manifest = DigestManifest(
+        new_prefix, stale_prefixes, {key: files[key] for key in keys if key in files}
+    )
+    return manifest, errors
+
+
+def _mismatch(expected: FileDigest, digest: FileDigest) -> typing.Optional[str]:
+    if digest.size != expected.size:
+        return f"size {digest.size} != {expected.size}"
+    if digest.sha256 == expected.sha256:
+        return None
+    details = [f"sha256 {digest.sha256} != {expected.sha256}"]
+    if digest.stale:
+        details.append(f"{digest.stale} stale prefix occurrences")
+    if digest.occurrences != expected.occurrences:
+        details.append(
+            f"{digest.occurrences} prefix occurrences != {expected.occurrences}"
+        )
+    return ", ".join(details)
+
+
+def verify(
+    root: pathlib.Path, manifest: DigestManifest, jobs: int = 0
+) -> typing.List[typing.Dict[str, str]]:
+    """
+    Check the files in `manifest` against their recorded digests, hashing
+    them with `jobs` threads (0 uses all cores). Files with a different size
+    are reported without reading them.
+
+    Returns a list of mismatches, one entry per file.
+    """
+    logger.info(f"verifying {len(manifest.files)} files in {root}")
+    errors = []
+    keys = []
+    sizes = []
+    for key, expected in manifest.files.items():
+        path = root / key
+        try:
+            size = os.stat(path).st_size
+        except OSError as e:
+            errors.append({"path": path.as_posix(), "error": repr(e)})
+            continue
+        if size != expected.size:
+            errors.append(
+                {"path": path.as_posix(), "error": f"size {size} != {expected.size}"}
+            )
+            continue
+        keys.append(key)
+        sizes.append(size)
+
+    results = _digest_all(
+        root, keys, sizes, manifest.new_prefix, manifest.stale_prefixes, jobs
+    )
+    for n, digest in results:
+        path = (root / keys[n]).as_posix()
+        if isinstance(digest, OSError):
+            error = repr(digest)
+        else:
+            error = _mismatch(manifest.files[keys[n]], digest)
+        if error is not None:
+            errors.append({"path": path, "error": error})
+    for error in errors:
+        logger.error(f"Verification failed for {error['path']}: {error['error']}")
+    logger.info(f"verified {len(manifest.files)} files, {len(errors)} mismatches")
+    return errors
@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+from ilastik_install import cache, core, report
+from test_main import check_prefixes, generate_paths
+
+
+def add_sha256(root):
+    """fake sha256s of the package files in conda-meta"""
+    spec_path = root / "conda-meta" / "test_spec.json"
+    spec = json.loads(spec_path.read_text())
+    for file in spec["paths_data"]["paths"]:
+        file["sha256"] = f"sha256-of-{file['_path']}"
+    spec_path.write_text(json.dumps(spec))
+
+
+def relocate(root, current_prefix, new_prefix, relocation_cache):
+    relocation_report = report.RelocationReport()
+    errors = core.replace_prefixes(
+        root / "conda-meta",
+        root,
+        current_prefix,
+        new_prefix,
+        relocation_report=relocation_report,
+        relocation_cache=relocation_cache,
+    )
+    assert errors == []
+    return relocation_report.totals()
+
+
+def test_relocation_cache(tmp_path):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    first = tmp_path / "first"
+    generate_paths(first, current_prefix.as_posix())
+    add_sha256(first)
+    second = tmp_path / "second"
+    shutil.copytree(first, second)
+    relocation_cache = cache.RelocationCache(tmp_path / "cache")
+
+    totals = relocate(first, current_prefix, new_prefix, relocation_cache)
+    assert totals[report.MODIFIED] == 3
+    entries = (tmp_path / "cache").glob("*/*")
+    assert len([p for p in entries if p.suffix != cache.USED_SUFFIX]) == 3
+
+    totals = relocate(second, current_prefix, new_prefix, relocation_cache)
+    assert totals[report.CACHED] == 3
+    assert totals[report.MODIFIED] == 0
+    check_prefixes(second, current_prefix, new_prefix)
+    for path in ["include/my_header.h", "lib/mylib.so.1.1.1"]:
+        assert os.path.samefile(first / path, second / path)
+
+    # relocating a linked install does not modify the cache (or other installs)
+    cached = {p: p.read_bytes() for p in (tmp_path / "cache").glob("*/*")}
+    other_prefix = tmp_path / "somewhere" / "else"
+    totals = relocate(second, new_prefix, other_prefix, relocation_cache)
+    assert totals[report.MODIFIED] == 3
+    check_prefixes(second, new_prefix, other_prefix)
+    check_prefixes(first, current_prefix, new_prefix)
+    assert all(p.read_bytes() == data for p, data in cached.items())
+
+
+def test_relocation_cache_evict(tmp_path):
+    relocation_cache = cache.RelocationCache(tmp_path / "cache", max_size=250)
+    source = tmp_path / "file"
+    for n in range(4):
+        source.write_bytes(bytes(100))
+        key = relocation_cache.key(f"sha{n}", 100, "/a", "/b")
+        relocation_cache.store(key, source)
+        source.unlink()
+        os.utime(relocation_cache.used_path(key), (n, n))
+    # most recently used
+    assert relocation_cache.fetch(relocation_cache.key("sha0", 100, "/a", "/b"), source)
+
+    relocation_cache.evict()
+    remaining = {
+        n
+        for n in range(4)
+        if relocation_cache.entry_path(
+            relocation_cache.key(f"sha{n}", 100, "/a", "/b")
+        ).exists()
+    }
+    assert remaining == {0, 3}
+
+
+def test_relocation_cache_not_owner(tmp_path, monkeypatch):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    first = tmp_path / "first"
+    generate_paths(first, current_prefix.as_posix())
+    add_sha256(first)
+    second = tmp_path / "second"
+    shutil.copytree(first, second)
+    relocation_cache = cache.RelocationCache(tmp_path / "cache")
+    relocate(first, current_prefix, new_prefix, relocation_cache)
+    mtimes = {p: p.stat().st_mtime_ns for p in first.glob("**/*")}
+
+    def utime(*args, **kwargs):
+        # entries (and stamps) of other users
+        raise PermissionError(1, "Operation not permitted")
+
+    monkeypatch.setattr(os, "utime", utime)
+    totals = relocate(second, current_prefix, new_prefix, relocation_cache)
+    assert totals[report.CACHED] == 3
+    assert totals[report.MODIFIED] == 0
+    # linked installs keep their mtimes
+    assert {p: p.stat().st_mtime_ns for p in first.glob("**/*")} == mtimes
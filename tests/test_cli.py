@@ -0,0 +1,140 @@
+import json
+import os
+import pytest
+import sys
+from ilastik_install import cli, core
+from test_main import generate_paths, check_prefixes
+
+
+def run_cli(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["ilastik-install", *map(str, args)])
+    cli.main()
+
+
+def test_relocation_needed(tmp_path):
+    generate_paths(tmp_path, "/some/prefix")
+    spec_file = tmp_path / ".prefix_previous"
+
+    cli.update_prefix_file(spec_file, tmp_path / "elsewhere")
+    assert cli.PrefixConfig(spec_file, tmp_path).relocation_needed()
+
+    # clean, but no fingerprint recorded
+    cli.update_prefix_file(spec_file, tmp_path)
+    assert cli.PrefixConfig(spec_file, tmp_path).relocation_needed()
+
+    cli.update_prefix_file(spec_file, tmp_path, core.install_fingerprint(tmp_path))
+    assert not cli.PrefixConfig(spec_file, tmp_path).relocation_needed()
+
+    (tmp_path / "conda-meta" / "new_package.json").write_text("{}")
+    assert cli.PrefixConfig(spec_file, tmp_path).relocation_needed()
+
+
+def test_main_skips_relocated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = tmp_path / "install"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(root, current_prefix.as_posix())
+    spec_file = root / ".prefix_previous"
+    cli.update_prefix_file(spec_file, current_prefix)
+
+    run_cli(monkeypatch, root)
+    check_prefixes(root, current_prefix, root)
+    with spec_file.open("r") as f:
+        assert json.load(f)["fingerprint"] == core.install_fingerprint(root)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("should not relocate")
+
+    with monkeypatch.context() as m:
+        m.setattr(core, "replace_prefixes", fail)
+        run_cli(monkeypatch, root)
+
+
+def test_main_copy_to(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source = tmp_path / "install"
+    destination = tmp_path / "copy"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(source, current_prefix.as_posix())
+    cli.update_prefix_file(source / ".prefix_previous", current_prefix)
+    original = (source / "lib" / "mylib.so.1.1.1").read_bytes()
+
+    run_cli(monkeypatch, source, "--copy-to", destination)
+    check_prefixes(destination, current_prefix, destination)
+    assert (source / "lib" / "mylib.so.1.1.1").read_bytes() == original
+    config = cli.PrefixConfig(destination / ".prefix_previous", destination)
+    assert not config.relocation_needed()
+
+
+def test_main_copy_to_many(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source = tmp_path / "install"
+    destinations = [tmp_path / "copy_a", tmp_path / "copy_b"]
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(source, current_prefix.as_posix())
+    cli.update_prefix_file(source / ".prefix_previous", current_prefix)
+
+    run_cli(monkeypatch, source, "--copy-to", *destinations)
+    for destination in destinations:
+        check_prefixes(destination, current_prefix, destination)
+        config = cli.PrefixConfig(destination / ".prefix_previous", destination)
+        assert not config.relocation_needed()
+
+
+def test_main_copy_to_nested(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source = tmp_path / "install"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(source, current_prefix.as_posix())
+    cli.update_prefix_file(source / ".prefix_previous", current_prefix)
+
+    with pytest.raises(SystemExit):
+        run_cli(monkeypatch, source, "--copy-to", source / "copy")
+    assert not (source / "copy").exists()
+
+
+def test_main_prefix_history(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = tmp_path / "first"
+    generate_paths(first, (tmp_path / "build").as_posix())
+    cli.update_prefix_file(first / ".prefix_previous", tmp_path / "build")
+    run_cli(monkeypatch, first)
+    second = tmp_path / "second"
+    first.rename(second)
+    run_cli(monkeypatch, second)
+
+    config = cli.PrefixConfig(second / ".prefix_previous", second)
+    assert config.history == [first, tmp_path / "build"]
+
+    # a file that was restored from the first install
+    header = second / "include" / "my_header.h"
+    header.write_text(first.as_posix())
+    third = tmp_path / "third"
+    second.rename(third)
+    run_cli(monkeypatch, third)
+    assert (third / "include" / "my_header.h").read_text() == third.as_posix()
+    config = cli.PrefixConfig(third / ".prefix_previous", third)
+    assert config.history == [second, first, tmp_path / "build"]
+
+
+def test_main_pipeline_jobs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = tmp_path / "install"
+    generate_paths(root, (tmp_path / "build").as_posix())
+    cli.update_prefix_file(root / ".prefix_previous", tmp_path / "build")
+
+    with pytest.raises(SystemExit):
+        run_cli(monkeypatch, root, "--pipeline", "--readers", "0")
+    with pytest.raises(SystemExit):
+        run_cli(monkeypatch, root, "--jobs", "-2", "--force")
+
+    configs = []
+
+    def replace_prefixes(*args, pipeline_config=None, **kwargs):
+        configs.append(pipeline_config)
+        return []
+
+    monkeypatch.setattr(core, "replace_prefixes", replace_prefixes)
+    monkeypatch.setattr(os, "cpu_count", lambda: 6)
+    run_cli(monkeypatch, root, "--pipeline", "--jobs", "0")
+    assert configs[0].workers == 6
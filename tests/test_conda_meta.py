@@ -0,0 +1,72 @@
+import json
+import random
+import pytest
+from ilastik_install import conda_meta
+
+PLACEHOLDER = "/opt/anaconda1anaconda2anaconda3"
+
+tricky_paths = [
+    "lib/libfoo.so",
+    "share/{{cookiecutter.name}}/setup.py",
+    'share/quote"d/{ "x": 1 }',
+    "share/{}",
+    "share/back\\slash{",
+    "share/ünïcødé/prefix_placeholder",
+    'share/"prefix_placeholder": "x"',
+]
+
+
+def make_spec(rng, n):
+    paths = []
+    for i in range(n):
+        entry = {
+            "_path": f"{rng.choice(tricky_paths)}/{i}",
+            "path_type": "hardlink",
+            "sha256": f"{rng.getrandbits(256):064x}",
+            "size_in_bytes": rng.randint(0, 1 << 20),
+        }
+        kind = rng.random()
+        if kind < 0.3:
+            entry.update(file_mode=rng.choice(["text", "binary"]))
+            entry["prefix_placeholder"] = PLACEHOLDER
+        elif kind < 0.35:
+            # placeholder without mode, not relocated
+            entry["prefix_placeholder"] = PLACEHOLDER
+        if rng.random() < 0.5:
+            entry = dict(reversed(list(entry.items())))
+        paths.append(entry)
+    return {
+        "name": "test",
+        "files": [entry["_path"] for entry in paths],
+        "paths_data": {"paths": paths, "paths_version": 1},
+    }
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_iter_relocatable(seed):
+    rng = random.Random(seed)
+    spec = make_spec(rng, rng.randint(0, 50))
+    expected = list(conda_meta.relocatable_paths(spec))
+    for dump_kwargs in [{}, {"indent": 2, "sort_keys": True}, {"ensure_ascii": False}]:
+        text = json.dumps(spec, **dump_kwargs)
+        assert list(conda_meta.iter_relocatable(text)) == expected
+
+
+def test_iter_relocatable_no_paths_data():
+    with pytest.raises(KeyError):
+        list(conda_meta.iter_relocatable('{"name": "test"}'))
+
+
+def test_read_packages(tmp_path):
+    rng = random.Random(0)
+    json_files = []
+    for n in range(5):
+        json_file = tmp_path / f"package-{n}.json"
+        json_file.write_text(json.dumps(make_spec(rng, 20)))
+        json_files.append(json_file)
+
+    packages = list(conda_meta.read_packages(json_files, max_workers=3))
+    assert [json_file for json_file, _ in packages] == json_files
+    for json_file, entries in packages:
+        spec = json.loads(json_file.read_text())
+        assert entries == list(conda_meta.relocatable_paths(spec))
@@ -2,11 +2,16 @@
 Test replacement operation.
 """
 from ilastik_install.external import _constructor
+import hashlib
+import io
+import os
 import pathlib
 import pytest
 import random
 import re
 import string
+import subprocess
+import sys
 import typing
 
 
@@ -187,3 +192,361 @@ def test_update_prefix_text_binary(
         bin_out = f.read()
 
     assert bin_out.count(new_prefix.encode("utf-8")) == occurrences
+
+
+@pytest.mark.parametrize(
+    "new_prefix,occurrences", [("1234", 5), ("1234567", 3), ("1234567890abcderfgh1", 1)]
+)
+def test_binary_replace_inplace(new_prefix: str, occurrences, tmp_path: pathlib.Path):
+    original_prefix = b"123456789_max_length"
+    current_prefix = b"whatever"
+    random_data = random_data_w_prefix(
+        2000, original_prefix, current_prefix, occurrences
+    )
+    expected = _constructor.binary_replace(
+        random_data, original_prefix, current_prefix, new_prefix.encode("utf-8")
+    )
+
+    bin_path = tmp_path / "binfile.bin"
+    bin_path.write_bytes(random_data)
+    inode = bin_path.stat().st_ino
+
+    stats = _constructor.binary_replace_inplace(
+        bin_path, original_prefix, current_prefix, new_prefix.encode("utf-8")
+    )
+
+    assert stats.modified
+    assert stats.matches == occurrences
+    assert len(stats.slots) == occurrences
+    assert bin_path.read_bytes() == expected
+    # file was patched, not replaced
+    assert bin_path.stat().st_ino == inode
+
+
+def test_binary_replace_inplace_known_slots(tmp_path: pathlib.Path, monkeypatch):
+    original_prefix = b"123456789_max_length"
+    random_data = random_data_w_prefix(2000, original_prefix, b"whatever", 5)
+    bin_path = tmp_path / "binfile.bin"
+    bin_path.write_bytes(random_data)
+
+    slots = _constructor.binary_replace_inplace(
+        bin_path, original_prefix, b"whatever", b"new"
+    ).slots
+    expected = _constructor.binary_replace(
+        bin_path.read_bytes(), original_prefix, b"new", b"newer"
+    )
+
+    def fail(*args):
+        raise AssertionError("file should not be scanned")
+
+    with monkeypatch.context() as m:
+        m.setattr(_constructor, "find_slots", fail)
+        stats = _constructor.binary_replace_inplace(
+            bin_path, original_prefix, b"new", b"newer", slots=slots
+        )
+    assert stats.modified
+    assert stats.slots == slots
+    assert stats.bytes_read == sum(end - start for start, end in slots)
+    assert bin_path.read_bytes() == expected
+
+    # stale slots are detected and the file is scanned again
+    stale_slots = [(start + 1, end) for start, end in slots]
+    assert not _constructor.valid_slots(bin_path.read_bytes(), stale_slots, b"newer")
+    stats = _constructor.binary_replace_inplace(
+        bin_path, original_prefix, b"newer", b"new", slots=stale_slots
+    )
+    assert stats.slots == slots
+    assert stats.bytes_read == len(random_data)
+
+
+def test_update_prefix_binary_fallback(tmp_path: pathlib.Path):
+    original_prefix = "123456789_max_length"
+    current_prefix = "whatever"
+    random_data = random_data_w_prefix(
+        2000, original_prefix.encode("utf-8"), current_prefix.encode("utf-8"), 3
+    )
+    bin_path = tmp_path / "binfile.bin"
+    bin_path.write_bytes(random_data)
+    link_path = tmp_path / "binfile.link"
+    os.link(bin_path, link_path)
+
+    # binaries are rewritten by default
+    _constructor.update_prefix(
+        bin_path, original_prefix, current_prefix, "new", "binary"
+    )
+
+    assert bin_path.read_bytes().count(b"new") == 3
+    # file was unlinked and rewritten, other links keep the old content
+    assert link_path.read_bytes() == random_data
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/maps"), reason="needs /proc/<pid>/maps"
+)
+def test_update_prefix_mapped_by_other_process(tmp_path: pathlib.Path):
+    original_prefix = "123456789_max_length"
+    current_prefix = "whatever"
+    random_data = random_data_w_prefix(
+        2000, original_prefix.encode("utf-8"), current_prefix.encode("utf-8"), 3
+    )
+    bin_path = tmp_path / "binfile.bin"
+    bin_path.write_bytes(random_data)
+    script = (
+        "import mmap, sys\n"
+        "f = open(sys.argv[1], 'rb')\n"
+        "m = mmap.mmap(f.fileno(), 0, mmap.MAP_PRIVATE, mmap.PROT_READ)\n"
+        "print('mapped', flush=True)\n"
+        "sys.stdin.read()\n"
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-c", script, str(bin_path)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        assert process.stdout.readline() == b"mapped\n"
+        _constructor.mapped_files.cache_clear()
+        assert os.path.realpath(bin_path) in _constructor.mapped_files()
+        inode = bin_path.stat().st_ino
+        _constructor.update_prefix(
+            bin_path, original_prefix, current_prefix, "new", "binary", inplace=True
+        )
+    finally:
+        process.communicate()
+        _constructor.mapped_files.cache_clear()
+
+    assert bin_path.read_bytes().count(b"new") == 3
+    # rewritten instead of patched in place
+    assert bin_path.stat().st_ino != inode
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 4096])
+@pytest.mark.parametrize(
+    "current_prefix,new_prefix",
+    [("something_random", "1234"), ("/x/x", "/yy/yy"), ("aa", "b")],
+)
+def test_stream_text_replace(
+    chunk_size: int, current_prefix: str, new_prefix: str, tmp_path: pathlib.Path
+):
+    txt = random_text_w_prefix(50, current_prefix, 7) + "aaaaa/x/x/x/x"
+    txt_file = tmp_path / "txt-file.txt"
+    txt_file.write_text(txt)
+    txt_file.chmod(0o640)
+
+    stats = _constructor.stream_text_replace(
+        txt_file,
+        current_prefix.encode("utf-8"),
+        new_prefix.encode("utf-8"),
+        chunk_size=chunk_size,
+    )
+
+    assert stats.modified
+    assert stats.matches == txt.count(current_prefix)
+    assert stats.bytes_read == len(txt)
+    assert txt_file.read_text() == txt.replace(current_prefix, new_prefix)
+    assert txt_file.stat().st_mode & 0o777 == 0o640
+    assert list(tmp_path.iterdir()) == [txt_file]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 4096])
+def test_stream_text_replace_late_change(chunk_size: int, tmp_path: pathlib.Path):
+    # the head (up to the first change) also contains the new prefix
+    txt = "x" * 500 + "/new/prefix:" + "y" * 300 + "/old/bin:/new/prefix/" + "z" * 5
+    txt_file = tmp_path / "txt-file.txt"
+    txt_file.write_text(txt)
+    current = _constructor.PrefixMatcher([b"/old", b"/new/prefix"])
+
+    stats = _constructor.stream_text_replace(
+        txt_file, current, b"/new/prefix", chunk_size=chunk_size
+    )
+
+    assert stats.modified
+    assert stats.matches == 3
+    assert stats.bytes_read == len(txt)
+    assert txt_file.read_text() == txt.replace("/old", "/new/prefix")
+    assert stats.bytes_written == len(txt_file.read_bytes())
+    assert list(tmp_path.iterdir()) == [txt_file]
+
+
+def test_stream_text_replace_unchanged(tmp_path: pathlib.Path, monkeypatch):
+    txt = "/new/prefix/bin:" * 100
+    txt_file = tmp_path / "txt-file.txt"
+    txt_file.write_text(txt)
+    inode = txt_file.stat().st_ino
+
+    def fail(*args, **kwargs):
+        raise AssertionError("unchanged files should not be written")
+
+    monkeypatch.setattr(_constructor.tempfile, "mkstemp", fail)
+    for current in [b"/old", _constructor.PrefixMatcher([b"/old", b"/new/prefix"])]:
+        stats = _constructor.stream_text_replace(
+            txt_file, current, b"/new/prefix", chunk_size=64
+        )
+        assert not stats.modified
+        assert stats.bytes_read == len(txt)
+        assert stats.bytes_written == 0
+    assert stats.matches == 100
+    assert txt_file.read_text() == txt
+    assert txt_file.stat().st_ino == inode
+
+
+def expected_digest(data: bytes, new_prefix: bytes, stale: int = 0):
+    return (hashlib.sha256(data).hexdigest(), len(data), data.count(new_prefix), stale)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 4096])
+@pytest.mark.parametrize("changed", [True, False])
+def test_stream_text_replace_digest(
+    chunk_size: int, changed: bool, tmp_path: pathlib.Path
+):
+    txt = "x" * 500 + "/new/prefix:" + "y" * 300 + "/new/prefix/" + "z" * 5
+    if changed:
+        txt += "/old/bin"
+    txt_file = tmp_path / "txt-file.txt"
+    txt_file.write_text(txt)
+    current = _constructor.PrefixMatcher([b"/old", b"/new/prefix"])
+
+    stats = _constructor.stream_text_replace(
+        txt_file, current, b"/new/prefix", chunk_size=chunk_size, digest=True
+    )
+
+    assert stats.modified == changed
+    assert stats.digest == expected_digest(txt_file.read_bytes(), b"/new/prefix")
+
+
+@pytest.mark.parametrize("inplace", [True, False])
+def test_update_prefix_digest(inplace: bool, tmp_path: pathlib.Path):
+    original = b"/opt/anaconda1anaconda2anaconda3"
+    binary = b"\x7fELF\0" + b"/old/one/lib:/old/two".ljust(40, b"\0") + b"/old/one\0"
+    binary_file = tmp_path / "lib.so"
+    binary_file.write_bytes(binary)
+    paths = [binary_file]
+    if inplace:
+        # empty files cannot be mapped
+        paths.append(tmp_path / "empty.so")
+        paths[-1].write_bytes(b"")
+
+    for path in paths:
+        stats = _constructor.update_prefix(
+            path,
+            original.decode(),
+            ["/old/one"],
+            "/new",
+            "binary",
+            inplace=inplace,
+            digest=True,
+        )
+        # the digest is of the written output, "/old/two" was not replaced
+        assert stats.digest == expected_digest(path.read_bytes(), b"/new")
+    assert binary_file.read_bytes().count(b"/new") == 2
+
+
+def replace_outcome(replace_fn, *args):
+    try:
+        return replace_fn(*args)
+    except (AssertionError, _constructor.PlaceholderLenghtError) as e:
+        return type(e)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_binary_replace_equivalence(seed: int):
+    """randomized comparison with the regex based reference implementation"""
+    rng = random.Random(seed)
+    alphabet = [b"\0", b"\0", b"a", b"b", b"/", b"ab", b"\0\0\0", b"\0" * 300]
+    current_prefix = b"".join(rng.choices([b"a", b"b", b"/"], k=rng.randint(1, 4)))
+    new_prefix = b"".join(rng.choices([b"a", b"c", b"/"], k=rng.randint(1, 6)))
+    original_prefix = b"x" * rng.randint(len(current_prefix), 8)
+    data = b"".join(
+        rng.choice(alphabet + [current_prefix] * 3) for _ in range(rng.randint(0, 300))
+    )
+
+    expected = replace_outcome(
+        _constructor.binary_replace_regex,
+        data,
+        original_prefix,
+        current_prefix,
+        new_prefix,
+    )
+    res = replace_outcome(
+        _constructor.binary_replace, data, original_prefix, current_prefix, new_prefix
+    )
+    assert res == expected
+    assert _constructor.find_slots(data, current_prefix) == [
+        m.span() for m in _constructor.slot_pattern(current_prefix).finditer(data)
+    ]
+
+
+def random_prefixes(rng: random.Random) -> _constructor.PrefixMatcher:
+    return _constructor.PrefixMatcher(
+        b"".join(rng.choices([b"a", b"b", b"/"], k=rng.randint(1, 4)))
+        for _ in range(rng.randint(1, 4))
+    )
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_prefix_matcher(seed: int):
+    """randomized comparison with a regex alternation (leftmost-longest)"""
+    rng = random.Random(seed)
+    matcher = random_prefixes(rng)
+    data = b"".join(rng.choices([b"a", b"b", b"/", b"c"], k=rng.randint(0, 100)))
+    pattern = re.compile(b"|".join(map(re.escape, matcher.prefixes)))
+
+    assert matcher.split(data) == pattern.split(data)
+    assert matcher.replace(data, b"NEW") == pattern.sub(b"NEW", data)
+    assert matcher.count(data) == len(pattern.findall(data))
+    for chunk_size in [1, 2, 5, 64]:
+        out = io.BytesIO()
+        stats = _constructor.replace_stream(
+            io.BytesIO(data), out, matcher, b"NEW", chunk_size
+        )
+        assert out.getvalue() == pattern.sub(b"NEW", data)
+        assert stats.matches == matcher.count(data)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_binary_replace_multiple_prefixes(seed: int):
+    """randomized comparison with the regex based reference implementation"""
+    rng = random.Random(seed)
+    alphabet = [b"\0", b"\0", b"a", b"b", b"/", b"ab", b"\0\0\0", b"\0" * 300]
+    matcher = random_prefixes(rng)
+    new_prefix = b"".join(rng.choices([b"a", b"c", b"/"], k=rng.randint(1, 6)))
+    original_prefix = b"x" * rng.randint(matcher.max_len, 8)
+    data = b"".join(
+        rng.choice(alphabet + list(matcher.prefixes) * 2)
+        for _ in range(rng.randint(0, 300))
+    )
+
+    expected = replace_outcome(
+        _constructor.binary_replace_regex, data, original_prefix, matcher, new_prefix
+    )
+    res = replace_outcome(
+        _constructor.binary_replace, data, original_prefix, matcher, new_prefix
+    )
+    assert res == expected
+    assert _constructor.find_slots(data, matcher) == [
+        m.span() for m in _constructor.slot_pattern(matcher).finditer(data)
+    ]
+
+
+def test_update_prefix_multiple_prefixes(tmp_path: pathlib.Path):
+    original = b"/opt/anaconda1anaconda2anaconda3"
+    old_prefixes = ["/old/one", "/old/one/two", "/elsewhere"]
+    slots = [(b"/old/one/lib", 33), (b"/elsewhere/lib:/old/one/two/lib", 51)]
+    binary = b"\x7fELF\0" + b"".join(slot.ljust(n, b"\0") for slot, n in slots)
+    binary_file = tmp_path / "lib.so"
+    binary_file.write_bytes(binary)
+    text_file = tmp_path / "script.sh"
+    text_file.write_text("/old/one/two/bin:/elsewhere/bin:/old/one/bin\n")
+
+    stats = _constructor.update_prefix(
+        binary_file, original.decode(), old_prefixes, "/new", "binary", inplace=True
+    )
+    assert stats.matches == 2
+    slots = [(b"/new/lib", 33), (b"/new/lib:/new/lib", 51)]
+    expected = b"\x7fELF\0" + b"".join(slot.ljust(n, b"\0") for slot, n in slots)
+    assert binary_file.read_bytes() == expected
+
+    _constructor.update_prefix(
+        text_file, original.decode(), old_prefixes, "/new", "text"
+    )
+    assert text_file.read_text() == "/new/bin:/new/bin:/new/bin\n"
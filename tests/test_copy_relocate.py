@@ -0,0 +1,115 @@
+import os
+import pytest
+from ilastik_install import copy_relocate, core
+from ilastik_install.external import _constructor
+from test_main import add_hardlinks, check_prefixes, generate_paths
+
+
+def snapshot(root):
+    return {
+        path.relative_to(root).as_posix(): path.read_bytes()
+        for path in root.rglob("*")
+        if path.is_file() and not path.is_symlink()
+    }
+
+
+def test_copy_relocate(tmp_path):
+    source = tmp_path / "source"
+    destination = tmp_path / "destination"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(source, current_prefix.as_posix())
+    add_hardlinks(source, [("lib/mylib.so.1.1.1", "lib/mylib.so.1")])
+    (source / "bin").mkdir()
+    (source / "bin" / "tool").write_bytes(b"\x7fELF no prefix here")
+    (source / "bin" / "tool").chmod(0o755)
+    os.symlink("mylib.so.1", source / "lib" / "mylib.so")
+    os.symlink("lib", source / "lib64")
+    (source / core.OCCURRENCES_FILE).write_text("{}")
+    (source / core.DIGESTS_FILE).write_text("{}")
+    before = snapshot(source)
+
+    errors = copy_relocate.copy_relocate(
+        source, destination, current_prefix, destination, jobs=2
+    )
+    assert errors == []
+    check_prefixes(destination, current_prefix, destination)
+    assert snapshot(source) == before
+
+    assert (destination / "bin" / "tool").read_bytes() == b"\x7fELF no prefix here"
+    assert os.access(destination / "bin" / "tool", os.X_OK)
+    assert os.readlink(destination / "lib" / "mylib.so") == "mylib.so.1"
+    assert os.readlink(destination / "lib64") == "lib"
+    assert os.path.samefile(
+        destination / "lib" / "mylib.so.1.1.1", destination / "lib" / "mylib.so.1"
+    )
+    assert not os.path.samefile(
+        source / "lib" / "mylib.so.1.1.1", destination / "lib" / "mylib.so.1.1.1"
+    )
+    assert not (destination / core.OCCURRENCES_FILE).exists()
+    assert not (destination / core.DIGESTS_FILE).exists()
+
+
+def test_copy_relocate_errors(tmp_path):
+    source = tmp_path / "source"
+    destination = tmp_path / "destination"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(source, current_prefix.as_posix())
+    # not linked in the copy, the file it links to could not be copied
+    add_hardlinks(source, [("lib/mylib.so.1.1.1", "lib/mylib.so.1")])
+
+    errors = copy_relocate.copy_relocate(
+        source, destination, current_prefix, tmp_path / ("x" * 600)
+    )
+    # reported once, for the first of the links
+    assert [error["path"] for error in errors] == [
+        (source / "lib" / "mylib.so.1").as_posix()
+    ]
+    assert not (destination / "lib" / "mylib.so.1").exists()
+    assert not (destination / "lib" / "mylib.so.1.1.1").exists()
+
+
+@pytest.mark.parametrize("destination", ["source/copy", ".", "source"])
+def test_copy_relocate_nested(tmp_path, destination):
+    source = tmp_path / "source"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(source, current_prefix.as_posix())
+    before = sorted(source.rglob("*"))
+
+    with pytest.raises(ValueError):
+        copy_relocate.copy_relocate(
+            source, tmp_path / destination, current_prefix, tmp_path / destination
+        )
+    # nothing was copied
+    assert sorted(source.rglob("*")) == before
+
+
+def test_copy_relocate_many(tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(source, current_prefix.as_posix())
+    add_hardlinks(source, [("include/my_header.h", "include/my_header_link.h")])
+    destinations = [tmp_path / "project_a", tmp_path / "nested" / "project_b"]
+
+    searched = []
+    find_slots = _constructor.find_slots
+
+    def counting_find_slots(data, current_placeholder):
+        searched.append(current_placeholder)
+        return find_slots(data, current_placeholder)
+
+    monkeypatch.setattr(_constructor, "find_slots", counting_find_slots)
+    errors = copy_relocate.copy_relocate_many(
+        source,
+        [(destination, destination) for destination in destinations],
+        current_prefix,
+        jobs=2,
+    )
+    assert errors == []
+    # one binary file, searched once for both destinations
+    assert len(searched) == 1
+    for destination in destinations:
+        check_prefixes(destination, current_prefix, destination)
+        assert os.path.samefile(
+            destination / "include/my_header.h",
+            destination / "include/my_header_link.h",
+        )
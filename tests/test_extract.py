@@ -0,0 +1,159 @@
+import io
+import os
+import tarfile
+import pytest
+from ilastik_install import cli, extract
+from test_cli import run_cli
+from test_main import add_hardlinks, check_prefixes, generate_paths
+
+
+@pytest.fixture
+def archive(tmp_path):
+    build = tmp_path / "build" / "ilastik"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(build, current_prefix.as_posix())
+    add_hardlinks(build, [("lib/mylib.so.1.1.1", "lib/mylib.so.1")])
+    os.symlink("mylib.so.1", build / "lib" / "mylib.so")
+    cli.update_prefix_file(build / ".prefix_previous", current_prefix)
+    archive_path = tmp_path / "ilastik.tar.gz"
+    with tarfile.open(archive_path, "w:gz") as tar:
+        tar.add(build, arcname="ilastik")
+    return archive_path, current_prefix
+
+
+def test_read_manifest(archive, tmp_path):
+    archive_path, current_prefix = archive
+    manifest = extract.read_manifest(archive_path)
+    assert manifest.root == "ilastik"
+    assert manifest.previous_prefix == current_prefix.as_posix()
+    assert {entry[1] for entry in manifest.entries} == {
+        "include/my_header.h",
+        "lib/pkgconfig/mylib-stubs.pc",
+        "lib/mylib.so.1.1.1",
+        "lib/mylib.so.1",
+    }
+
+    manifest_path = extract.write_manifest(archive_path)
+    assert manifest_path == tmp_path / "ilastik.tar.gz.relocation.json"
+    assert extract.Manifest.load(manifest_path) == manifest
+
+
+@pytest.mark.parametrize("with_manifest", [False, True])
+def test_extract_relocate(archive, tmp_path, monkeypatch, with_manifest):
+    archive_path, current_prefix = archive
+    destination = tmp_path / "installed"
+    if with_manifest:
+        extract.write_manifest(archive_path)
+
+        def fail(*args):
+            raise AssertionError("should use the manifest")
+
+        monkeypatch.setattr(extract, "read_manifest", fail)
+
+    errors = extract.extract_relocate(archive_path, destination, destination)
+    assert errors == []
+    check_prefixes(destination, current_prefix, destination)
+    assert os.readlink(destination / "lib" / "mylib.so") == "mylib.so.1"
+    assert os.path.samefile(
+        destination / "lib" / "mylib.so.1.1.1", destination / "lib" / "mylib.so.1"
+    )
+
+
+def test_extract_relocate_stale_manifest(archive, tmp_path):
+    archive_path, current_prefix = archive
+    extract.write_manifest(archive_path)
+    # a newer archive (built elsewhere) written over the old one
+    build = tmp_path / "build" / "ilastik"
+    newer_prefix = tmp_path / "somewhere" / "else"
+    cli.update_prefix_file(build / ".prefix_previous", newer_prefix)
+    for path in build.rglob("*"):
+        if path.is_file() and not path.is_symlink():
+            path.write_bytes(
+                path.read_bytes().replace(
+                    current_prefix.as_posix().encode(), newer_prefix.as_posix().encode()
+                )
+            )
+    with tarfile.open(archive_path, "w:gz") as tar:
+        tar.add(build, arcname="ilastik")
+
+    destination = tmp_path / "installed"
+    errors = extract.extract_relocate(archive_path, destination, destination)
+    assert errors == []
+    check_prefixes(destination, newer_prefix, destination)
+
+
+def test_extract_relocate_outside(archive, tmp_path):
+    archive_path, current_prefix = archive
+    manifest = extract.read_manifest(archive_path)
+    evil_path = tmp_path / "evil.tar"
+    payload = tmp_path / "payload"
+    payload.write_text("evil")
+    with tarfile.open(evil_path, "w") as tar:
+        tar.add(payload, arcname="ilastik/../../payload")
+    destination = tmp_path / "nested" / "installed"
+
+    errors = extract.extract_relocate(evil_path, destination, destination, manifest)
+    assert [error["path"] for error in errors] == ["ilastik/../../payload"]
+    assert not (tmp_path / "nested" / "payload").exists()
+
+
+def _add_symlink(tar, name, linkname):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.SYMTYPE
+    info.linkname = linkname
+    tar.addfile(info)
+
+
+def _add_file(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+@pytest.mark.parametrize("linkname", ["absolute", "../../outside"])
+def test_extract_relocate_symlink_outside(tmp_path, linkname):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    if linkname == "absolute":
+        linkname = outside.as_posix()
+    evil_path = tmp_path / "evil.tar"
+    with tarfile.open(evil_path, "w") as tar:
+        _add_symlink(tar, "inst/escape", linkname)
+        _add_file(tar, "inst/escape/pwned", b"evil")
+    destination = tmp_path / "installed"
+    manifest = extract.Manifest("inst", "/some/prefix", [])
+
+    errors = extract.extract_relocate(evil_path, destination, destination, manifest)
+    assert "inst/escape" in [error["path"] for error in errors]
+    assert not (outside / "pwned").exists()
+    assert not os.path.islink(destination / "escape")
+
+
+def test_extract_relocate_through_existing_symlink(tmp_path):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    destination = tmp_path / "installed"
+    destination.mkdir()
+    os.symlink(outside, destination / "escape")
+    evil_path = tmp_path / "evil.tar"
+    with tarfile.open(evil_path, "w") as tar:
+        _add_file(tar, "inst/escape/pwned", b"evil")
+        _add_file(tar, "inst/escape/sub/pwned", b"evil")
+    manifest = extract.Manifest("inst", "/some/prefix", [])
+
+    errors = extract.extract_relocate(evil_path, destination, destination, manifest)
+    assert [error["path"] for error in errors] == [
+        "inst/escape/pwned",
+        "inst/escape/sub/pwned",
+    ]
+    assert list(outside.iterdir()) == []
+
+
+def test_main_from_archive(archive, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    archive_path, current_prefix = archive
+    destination = tmp_path / "installed"
+    run_cli(monkeypatch, destination, "--from-archive", archive_path)
+    check_prefixes(destination, current_prefix, destination)
+    config = cli.PrefixConfig(destination / ".prefix_previous", destination)
+    assert not config.relocation_needed()
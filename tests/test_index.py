@@ -0,0 +1,56 @@
+import os
+from ilastik_install import conda_meta, core, index
+from test_main import generate_paths, check_prefixes, package_spec
+
+
+def test_index_is_reused(tmp_path, monkeypatch):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    index_path = tmp_path / ".relocation_index"
+
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        new_prefix,
+        index_path=index_path,
+    )
+    assert errors == []
+    assert index_path.exists()
+    check_prefixes(tmp_path, current_prefix, new_prefix)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("conda-meta should not be parsed")
+
+    monkeypatch.setattr(conda_meta, "read_packages", fail)
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        new_prefix,
+        current_prefix,
+        index_path=index_path,
+    )
+    assert errors == []
+    check_prefixes(tmp_path, new_prefix, current_prefix)
+
+
+def test_index_invalidated(tmp_path):
+    generate_paths(tmp_path, "/some/prefix")
+    conda_meta = tmp_path / "conda-meta"
+    index_path = tmp_path / ".relocation_index"
+    entries = list(core.collect_file_specs(conda_meta, tmp_path, index_path))
+    assert len(entries) == len(package_spec["paths_data"]["paths"])
+    assert all(e.package == "test_spec" for e in entries)
+
+    relocation_index = index.RelocationIndex.load(index_path)
+    assert relocation_index.fingerprint == index.conda_meta_fingerprint(conda_meta)
+
+    st = (conda_meta / "test_spec.json").stat()
+    os.utime(conda_meta / "test_spec.json", ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    (conda_meta / "other.json").write_text('{"paths_data": {"paths": []}}')
+    entries = list(core.collect_file_specs(conda_meta, tmp_path, index_path))
+    assert len(entries) == len(package_spec["paths_data"]["paths"])
+    relocation_index = index.RelocationIndex.load(index_path)
+    assert relocation_index.fingerprint == index.conda_meta_fingerprint(conda_meta)
+    assert len(relocation_index.fingerprint) == 2
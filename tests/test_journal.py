@@ -0,0 +1,118 @@
+import pytest
+from ilastik_install import core, journal, pipeline, report
+from ilastik_install.external import _constructor
+from test_main import generate_paths, check_prefixes, package_spec
+
+
+def interrupt_after(monkeypatch, n_files: int):
+    update_prefix = _constructor.update_prefix
+    calls = []
+
+    def interrupted_update_prefix(*args, **kwargs):
+        if len(calls) == n_files:
+            raise KeyboardInterrupt()
+        calls.append(args)
+        return update_prefix(*args, **kwargs)
+
+    monkeypatch.setattr(_constructor, "update_prefix", interrupted_update_prefix)
+
+
+@pytest.mark.parametrize("resume_to", ["blah", "other"])
+def test_resume_interrupted(tmp_path, monkeypatch, resume_to):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    journal_path = tmp_path / ".relocation_journal"
+
+    with monkeypatch.context() as m:
+        interrupt_after(m, 2)
+        with pytest.raises(KeyboardInterrupt):
+            core.replace_prefixes(
+                tmp_path / "conda-meta",
+                tmp_path,
+                current_prefix,
+                new_prefix,
+                journal_path=journal_path,
+            )
+    assert len(journal_path.read_text().splitlines()) == 3
+
+    # the prefix file was not updated, relocation starts from current_prefix
+    resume_prefix = tmp_path / "somewhere" / resume_to
+    relocation_report = report.RelocationReport()
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        resume_prefix,
+        relocation_report=relocation_report,
+        journal_path=journal_path,
+    )
+    assert errors == []
+    check_prefixes(tmp_path, current_prefix, resume_prefix)
+    totals = relocation_report.totals()
+    if resume_prefix == new_prefix:
+        assert totals[report.SKIPPED] == 2
+        assert totals[report.MODIFIED] == 1
+    else:
+        assert totals[report.MODIFIED] == 3
+
+    journal.discard(journal_path)
+    assert not journal_path.exists()
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_resume_written_not_journaled(tmp_path, monkeypatch, pipelined):
+    # the new prefix starts with the current one
+    current_prefix = tmp_path / "opt" / "ilastik"
+    new_prefix = tmp_path / "opt" / "ilastik-1.4"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    journal_path = tmp_path / ".relocation_journal"
+
+    def interrupted_record(*args):
+        raise KeyboardInterrupt()
+
+    with monkeypatch.context() as m:
+        # the first file is written, but the run dies before it is journaled
+        m.setattr(journal.RelocationJournal, "record", interrupted_record)
+        with pytest.raises(KeyboardInterrupt):
+            core.replace_prefixes(
+                tmp_path / "conda-meta",
+                tmp_path,
+                current_prefix,
+                new_prefix,
+                journal_path=journal_path,
+            )
+
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        new_prefix,
+        journal_path=journal_path,
+        pipeline_config=pipeline.PipelineConfig() if pipelined else None,
+    )
+    assert errors == []
+    for file in package_spec["paths_data"]["paths"]:
+        data = (tmp_path / file["_path"]).read_bytes()
+        assert data.count(new_prefix.as_posix().encode()) == file["__occurences"]
+        assert b"ilastik-1.4-1.4" not in data
+
+
+def test_stale_journal_ignored(tmp_path):
+    journal_path = tmp_path / ".relocation_journal"
+    relocation_journal = journal.RelocationJournal(journal_path, "/a", "/b")
+    relocation_journal.record("lib/file", "/b")
+    relocation_journal.close()
+
+    relocation_journal = journal.RelocationJournal(journal_path, "/a", "/c")
+    assert relocation_journal.source_prefixes("lib/file", "/a", "/c") == ["/b"]
+    assert relocation_journal.source_prefixes("lib/other", "/a", "/c") == [
+        "/a",
+        "/b",
+        "/c",
+    ]
+    relocation_journal.close()
+
+    relocation_journal = journal.RelocationJournal(journal_path, "/x", "/c")
+    assert relocation_journal.source_prefixes("lib/file", "/x", "/c") == ["/x"]
+    relocation_journal.close()
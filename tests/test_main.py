@@ -1,6 +1,9 @@
 import json
+import os
+import pytest
 from json import JSONEncoder
-from ilastik_install import core
+from ilastik_install import core, occurrences, pipeline, report
+from ilastik_install.external import _constructor
 from test_constructor import random_data_w_prefix, random_text_w_prefix
 import pathlib
 
@@ -104,3 +107,221 @@ def test_main(tmp_path):
         new_placeholder=new_prefix,
     )
     check_prefixes(tmp_path, current_prefix, new_prefix)
+
+
+def test_main_parallel(tmp_path):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    errors = core.replace_prefixes(
+        conda_meta_path=tmp_path / "conda-meta",
+        root=tmp_path,
+        current_placeholder=current_prefix,
+        new_placeholder=new_prefix,
+        jobs=2,
+    )
+    assert errors == []
+    check_prefixes(tmp_path, current_prefix, new_prefix)
+
+
+def test_main_collects_errors(tmp_path):
+    current_prefix = tmp_path / "somewhere" / "here"
+    # longer than the binary placeholder -> cannot be relocated
+    new_prefix = tmp_path / ("x" * 300)
+    generate_paths(tmp_path, current_prefix.as_posix())
+    errors = core.replace_prefixes(
+        conda_meta_path=tmp_path / "conda-meta",
+        root=tmp_path,
+        current_placeholder=current_prefix,
+        new_placeholder=new_prefix,
+        jobs=2,
+    )
+    assert len(errors) == 1
+    assert errors[0]["path"] == (tmp_path / "lib/mylib.so.1.1.1").as_posix()
+    assert "PlaceholderLenghtError" in errors[0]["error"]
+
+
+def test_main_recorded_occurrences(tmp_path, monkeypatch):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    occurrences_path = tmp_path / ".relocation_occurrences"
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        new_prefix,
+        occurrences_path=occurrences_path,
+        inplace=True,
+    )
+    assert errors == []
+    records = occurrences.load(occurrences_path)
+    assert list(records) == ["lib/mylib.so.1.1.1"]
+    assert len(records["lib/mylib.so.1.1.1"]["slots"]) == 23
+
+    def fail(*args):
+        raise AssertionError("file should not be scanned")
+
+    monkeypatch.setattr(_constructor, "find_slots", fail)
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        new_prefix,
+        current_prefix,
+        occurrences_path=occurrences_path,
+        inplace=True,
+    )
+    assert errors == []
+    check_prefixes(tmp_path, new_prefix, current_prefix)
+
+
+def test_main_report(tmp_path):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    (tmp_path / "include/my_header.h").unlink()
+    relocation_report = report.RelocationReport()
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        new_prefix,
+        relocation_report=relocation_report,
+    )
+    assert errors == []
+    report_path = tmp_path / "report.json"
+    relocation_report.save(report_path, top_n=2)
+    with report_path.open("r") as f:
+        summary = json.load(f)
+
+    assert set(summary["phases"]) >= {"collect", "relocate"}
+    totals = summary["totals"]
+    assert totals["files"] == 3
+    assert totals["missing"] == 1
+    assert totals["modified"] == 2
+    assert totals["matches"] == 2 + 23
+    assert totals["bytes_read"] > 0
+    assert len(summary["slowest_files"]) == 2
+    assert summary["slowest_packages"][0]["package"] == "test_spec"
+    missing = [f for f in summary["files"] if f["status"] == "missing"]
+    assert [f["path"] for f in missing] == ["include/my_header.h"]
+
+
+def add_hardlinks(tmp_path, links):
+    """hardlink files and add the links to the package spec"""
+    spec_path = tmp_path / "conda-meta" / "test_spec.json"
+    with spec_path.open("r") as f:
+        spec = json.load(f)
+    for source, link in links:
+        os.link(tmp_path / source, tmp_path / link)
+        for file in package_spec["paths_data"]["paths"]:
+            if file["_path"] == source:
+                spec["paths_data"]["paths"].append({**file, "_path": link})
+    with spec_path.open("w") as f:
+        json.dump(spec, f)
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_main_hardlinks(tmp_path, pipelined):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    add_hardlinks(
+        tmp_path,
+        [
+            ("lib/mylib.so.1.1.1", "lib/mylib.so.1"),
+            ("include/my_header.h", "include/my_header_link.h"),
+        ],
+    )
+    relocation_report = report.RelocationReport()
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        new_prefix,
+        relocation_report=relocation_report,
+        pipeline_config=pipeline.PipelineConfig() if pipelined else None,
+    )
+    assert errors == []
+    check_prefixes(tmp_path, current_prefix, new_prefix)
+    assert relocation_report.totals()[report.DEDUPLICATED] == 2
+    for source, link in [
+        ("lib/mylib.so.1.1.1", "lib/mylib.so.1"),
+        ("include/my_header.h", "include/my_header_link.h"),
+    ]:
+        assert os.path.samefile(tmp_path / source, tmp_path / link)
+
+
+def test_main_hardlink_outside(tmp_path):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    add_hardlinks(tmp_path, [("lib/mylib.so.1.1.1", "lib/mylib.so.1")])
+    # e.g. the conda package cache
+    outside = tmp_path / "pkgs" / "mylib.so.1.1.1"
+    outside.parent.mkdir()
+    os.link(tmp_path / "lib/mylib.so.1.1.1", outside)
+    original = outside.read_bytes()
+
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta", tmp_path, current_prefix, new_prefix
+    )
+    assert errors == []
+    check_prefixes(tmp_path, current_prefix, new_prefix)
+    assert outside.read_bytes() == original
+    assert os.path.samefile(
+        tmp_path / "lib/mylib.so.1.1.1", tmp_path / "lib/mylib.so.1"
+    )
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_main_history(tmp_path, pipelined):
+    older_prefix = tmp_path / "somewhere" / "older"
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    # partly relocated before
+    header = tmp_path / "include/my_header.h"
+    header.write_text(header.read_text() + older_prefix.as_posix())
+    too_long = pathlib.Path("/" + "x" * 300)
+
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        new_prefix,
+        pipeline_config=pipeline.PipelineConfig() if pipelined else None,
+        history=[older_prefix, too_long],
+    )
+    assert errors == []
+    text = header.read_text()
+    assert older_prefix.as_posix() not in text
+    assert current_prefix.as_posix() not in text
+    assert text.count(new_prefix.as_posix()) == 2
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_main_history_same_prefix(tmp_path, pipelined):
+    older_prefix = tmp_path / "somewhere" / "older"
+    generate_paths(tmp_path, tmp_path.as_posix())
+    paths = [tmp_path / file["_path"] for file in package_spec["paths_data"]["paths"]]
+    inodes = [path.stat().st_ino for path in paths]
+    contents = [path.read_bytes() for path in paths]
+    relocation_report = report.RelocationReport()
+
+    # e.g. after the fingerprint changed, or with --force
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        tmp_path,
+        tmp_path,
+        relocation_report=relocation_report,
+        pipeline_config=pipeline.PipelineConfig() if pipelined else None,
+        history=[older_prefix],
+    )
+    assert errors == []
+    assert [path.stat().st_ino for path in paths] == inodes
+    assert [path.read_bytes() for path in paths] == contents
+    totals = relocation_report.totals()
+    assert totals[report.MODIFIED] == 0
+    assert totals[report.UNCHANGED] == 3
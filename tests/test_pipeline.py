@@ -0,0 +1,62 @@
+import pytest
+from ilastik_install import core, pipeline
+from test_main import generate_paths, check_prefixes, package_spec
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        pipeline.PipelineConfig(),
+        pipeline.PipelineConfig(readers=1, workers=1, writers=1, queue_depth=1),
+        pipeline.PipelineConfig(readers=3, workers=2, writers=2, queue_depth=1),
+    ],
+)
+def test_pipeline(tmp_path, config):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    serial_root = tmp_path / "serial"
+    generate_paths(serial_root, current_prefix.as_posix())
+    for path in package_spec["paths_data"]["paths"]:
+        (serial_root / path["_path"]).write_bytes(
+            (tmp_path / path["_path"]).read_bytes()
+        )
+
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        new_prefix,
+        pipeline_config=config,
+    )
+    assert errors == []
+    check_prefixes(tmp_path, current_prefix, new_prefix)
+
+    core.replace_prefixes(
+        serial_root / "conda-meta", serial_root, current_prefix, new_prefix
+    )
+    for path in package_spec["paths_data"]["paths"]:
+        assert (tmp_path / path["_path"]).read_bytes() == (
+            serial_root / path["_path"]
+        ).read_bytes()
+
+
+def test_pipeline_errors(tmp_path):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / ("x" * 300)
+    generate_paths(tmp_path, current_prefix.as_posix())
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        new_prefix,
+        pipeline_config=pipeline.PipelineConfig(queue_depth=1),
+    )
+    assert len(errors) == 1
+    assert "PlaceholderLenghtError" in errors[0]["error"]
+
+
+@pytest.mark.parametrize("field", ["readers", "workers", "writers", "queue_depth"])
+def test_pipeline_config_invalid(field):
+    with pytest.raises(ValueError):
+        pipeline.PipelineConfig(**{field: 0})
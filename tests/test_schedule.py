@@ -0,0 +1,128 @@
+import concurrent.futures
+import threading
+import pytest
+from ilastik_install import core, pipeline, report, schedule
+from ilastik_install.external import _constructor
+from test_main import generate_paths, check_prefixes, package_spec
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("123", 123),
+        ("4K", 4096),
+        ("512M", 512 << 20),
+        ("1.5g", 3 << 29),
+        ("2GiB", 2 << 30),
+    ],
+)
+def test_parse_size(text, expected):
+    assert schedule.parse_size(text) == expected
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        schedule.parse_size("lots")
+
+
+def test_budgeted_map():
+    costs = [10, 40, 30, 20, 50]
+    budget = schedule.MemoryBudget(60)
+    in_flight = []
+    lock = threading.Lock()
+
+    def work(n):
+        with lock:
+            in_flight.append(budget.in_flight)
+        return n * 2
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = dict(
+            schedule.budgeted_map(executor, work, costs, budget, range(len(costs)))
+        )
+    assert results == {n: n * 2 for n in range(len(costs))}
+    assert budget.in_flight == 0
+    assert max(in_flight) <= 60
+    assert budget.peak <= 60
+
+
+def test_budgeted_map_max_pending():
+    costs = [10, 40, 30, 20, 50]
+    budget = schedule.MemoryBudget()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = dict(
+            schedule.budgeted_map(
+                executor, abs, costs, budget, range(len(costs)), max_pending=2
+            )
+        )
+    assert results == {n: n for n in range(len(costs))}
+    # the two largest files
+    assert budget.peak == 90
+
+
+def test_budget_admits_oversized_work_alone():
+    budget = schedule.MemoryBudget(10)
+    assert budget.try_acquire(100)
+    assert not budget.try_acquire(1)
+    budget.release(100)
+    assert budget.try_acquire(1)
+    assert budget.peak == 100
+
+
+def test_largest_first():
+    assert schedule.largest_first([1, 5, 3, 5]) == [1, 3, 2, 0]
+
+
+@pytest.mark.parametrize(
+    "mode, size, pipelined, inplace, expected",
+    [
+        ("binary", 100, False, False, 200),
+        ("binary", 100, False, True, 100),
+        ("binary", 100, True, True, 300),
+        ("text", 100, False, False, 200),
+        ("text", 1 << 30, False, False, 2 * _constructor.TEXT_CHUNK_SIZE),
+    ],
+)
+def test_estimated_memory(mode, size, pipelined, inplace, expected):
+    assert schedule.estimated_memory(mode, size, pipelined, inplace) == expected
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+@pytest.mark.parametrize("inplace", [False, True])
+@pytest.mark.parametrize("max_memory", [1000, None])
+def test_replace_prefixes_max_memory(tmp_path, pipelined, inplace, max_memory):
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(tmp_path, current_prefix.as_posix())
+    costs = sorted(
+        schedule.estimated_memory(
+            file["file_mode"],
+            (tmp_path / file["_path"]).stat().st_size,
+            pipelined,
+            inplace,
+        )
+        for file in package_spec["paths_data"]["paths"]
+    )
+    relocation_report = report.RelocationReport()
+
+    errors = core.replace_prefixes(
+        tmp_path / "conda-meta",
+        tmp_path,
+        current_prefix,
+        new_prefix,
+        jobs=2,
+        relocation_report=relocation_report,
+        pipeline_config=pipeline.PipelineConfig() if pipelined else None,
+        max_memory=max_memory,
+        inplace=inplace,
+    )
+    assert errors == []
+    check_prefixes(tmp_path, current_prefix, new_prefix)
+    info = relocation_report.info
+    assert info["max_memory"] == max_memory
+    if max_memory is not None:
+        # every file exceeds the budget and is relocated alone
+        assert info["peak_memory_estimate"] == costs[-1]
+    elif not pipelined:
+        # at most one file per process
+        assert costs[-1] <= info["peak_memory_estimate"] <= sum(costs[-2:])
@@ -0,0 +1,152 @@
+import hashlib
+import pytest
+from ilastik_install import cli, core, pipeline, verify
+from test_cli import run_cli
+from test_main import check_prefixes, generate_paths, package_spec
+
+
+@pytest.mark.parametrize("buffer_size", [1, 3, 7, 1 << 22])
+def test_digest_file(tmp_path, buffer_size):
+    data = b"xx/new/prefix/a/old/b/old/prefix:/new/prefix/old/new/prefix/old"
+    path = tmp_path / "file"
+    path.write_bytes(data)
+    digest = verify.digest_file(
+        path, b"/new/prefix", [b"/old", b"/new"], buffer_size=buffer_size
+    )
+    assert digest == verify.FileDigest(
+        hashlib.sha256(data).hexdigest(), len(data), 3, 4
+    )
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_record_and_verify(tmp_path, pipelined):
+    root = tmp_path / "install"
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(root, current_prefix.as_posix())
+    digests_path = root / core.DIGESTS_FILE
+    errors = core.replace_prefixes(
+        root / "conda-meta",
+        root,
+        current_prefix,
+        new_prefix,
+        digests_path=digests_path,
+        pipeline_config=pipeline.PipelineConfig() if pipelined else None,
+    )
+    assert errors == []
+    check_prefixes(root, current_prefix, new_prefix)
+
+    manifest = verify.DigestManifest.load(digests_path)
+    assert manifest.new_prefix == new_prefix.as_posix()
+    assert manifest.stale_prefixes == [current_prefix.as_posix()]
+    files = package_spec["paths_data"]["paths"]
+    assert set(manifest.files) == {file["_path"] for file in files}
+    for file in files:
+        digest = manifest.files[file["_path"]]
+        data = (root / file["_path"]).read_bytes()
+        assert digest.sha256 == hashlib.sha256(data).hexdigest()
+        assert digest.occurrences == file["__occurences"]
+    assert verify.verify(root, manifest, jobs=4) == []
+
+    text_file, truncated, binary_file = [root / file["_path"] for file in files]
+    # same size, different contents
+    data = bytearray(binary_file.read_bytes())
+    data[-1] ^= 0xFF
+    binary_file.write_bytes(bytes(data))
+    text_file.write_text(
+        text_file.read_text().replace(new_prefix.as_posix(), current_prefix.as_posix())
+    )
+    truncated.write_bytes(truncated.read_bytes()[:-1])
+    errors = {e["path"]: e["error"] for e in verify.verify(root, manifest)}
+    assert set(errors) == {p.as_posix() for p in [text_file, truncated, binary_file]}
+    assert errors[binary_file.as_posix()].startswith("sha256")
+    assert "stale prefix" in errors[text_file.as_posix()]
+    assert errors[truncated.as_posix()].startswith("size")
+
+    truncated.unlink()
+    errors = {e["path"]: e["error"] for e in verify.verify(root, manifest)}
+    assert "FileNotFoundError" in errors[truncated.as_posix()]
+
+
+def test_record_stale(tmp_path, monkeypatch):
+    root = tmp_path / "install"
+    current_prefix = tmp_path / "somewhere" / "here"
+    new_prefix = tmp_path / "somewhere" / "blah"
+    generate_paths(root, current_prefix.as_posix())
+    first = package_spec["paths_data"]["paths"][0]["_path"]
+
+    relocate_file = core.relocate_file
+
+    def skip_first(file_spec, *args, **kwargs):
+        if file_spec.path == root / first:
+            return core.FileResult(file_spec, stats=core._constructor.UpdateStats())
+        return relocate_file(file_spec, *args, **kwargs)
+
+    monkeypatch.setattr(core, "relocate_file", skip_first)
+    errors = core.replace_prefixes(
+        root / "conda-meta",
+        root,
+        current_prefix,
+        new_prefix,
+        digests_path=root / core.DIGESTS_FILE,
+    )
+    assert [e["path"] for e in errors] == [(root / first).as_posix()]
+
+
+def test_main_verify_corrupt_write(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = tmp_path / "install"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(root, current_prefix.as_posix())
+    spec_file = root / ".prefix_previous"
+    cli.update_prefix_file(spec_file, current_prefix)
+    binary_file = root / package_spec["paths_data"]["paths"][2]["_path"]
+
+    relocate_file = core.relocate_file
+
+    def corrupt_binary(file_spec, *args, **kwargs):
+        result = relocate_file(file_spec, *args, **kwargs)
+        if file_spec.path == binary_file:
+            # e.g. a write that did not make it to disk
+            data = bytearray(binary_file.read_bytes())
+            data[-1] ^= 0xFF
+            binary_file.write_bytes(bytes(data))
+        return result
+
+    monkeypatch.setattr(core, "relocate_file", corrupt_binary)
+    with pytest.raises(SystemExit):
+        run_cli(monkeypatch, root, "--verify")
+    manifest = verify.DigestManifest.load(root / core.DIGESTS_FILE)
+    errors = verify.verify(root, manifest)
+    assert [e["path"] for e in errors] == [binary_file.as_posix()]
+    # not marked as relocated
+    assert cli.PrefixConfig(spec_file, root).relocation_needed()
+
+
+def test_main_verify(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = tmp_path / "install"
+    current_prefix = tmp_path / "somewhere" / "here"
+    generate_paths(root, current_prefix.as_posix())
+    cli.update_prefix_file(root / ".prefix_previous", current_prefix)
+
+    # nothing recorded yet
+    with pytest.raises(SystemExit):
+        run_cli(monkeypatch, root, "--verify-only")
+
+    run_cli(monkeypatch, root, "--verify")
+    check_prefixes(root, current_prefix, root)
+    assert (root / core.DIGESTS_FILE).exists()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("should not relocate")
+
+    with monkeypatch.context() as m:
+        m.setattr(core, "replace_prefixes", fail)
+        run_cli(monkeypatch, root, "--verify-only")
+        run_cli(monkeypatch, root, "--verify")
+
+        binary_file = root / package_spec["paths_data"]["paths"][2]["_path"]
+        binary_file.write_bytes(binary_file.read_bytes()[:-1])
+        with pytest.raises(SystemExit):
+            run_cli(monkeypatch, root, "--verify-only")